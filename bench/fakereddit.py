@@ -0,0 +1,201 @@
+"""A stand-in for the parts of reddit's API flairbot uses, for load tests.
+
+    python bench/fakereddit.py [-p PORT] [--users N] [--latency MS] [--jitter MS] [--errors RATE]
+
+Point the app at it with ``REDDIT_URL = 'http://127.0.0.1:PORT'`` (``bench/load.py`` does this
+for you). It knows about OAuth token refreshes, ``/api/v1/me``, a subreddit's moderators,
+``flairlist``, ``flair``, ``flaircsv``, the moderator's subreddits and ``stylesheet.css``.
+Any subreddit name is accepted, and they all share one flair list.
+
+There are *N* users, ``user0`` to ``user{N-1}``, whose flair is given by ``flair_for`` so a load
+test can work out who has what without asking. Flair changes are kept in memory. Each response
+is delayed by *latency* ± *jitter* milliseconds, and a fraction *errors* of them fail with a 503.
+"""
+
+import argparse
+import binascii
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from flask import Flask, Response, request
+
+MODERATOR = 'bench_mod'
+FLAIRS = 500
+
+app = Flask(__name__)
+settings = {'users': 10000, 'latency': 0.0, 'jitter': 0.0, 'errors': 0.0}
+changed = {}
+changed_lock = threading.Lock()
+
+
+def flair_for(i):
+    """(text, css class) for ``user{i}``, before anyone's traded."""
+    n = i % FLAIRS
+    return 'Flair {}'.format(n), ('special{}' if n % 50 == 0 else 'f{}').format(n)
+
+
+def _user_index(name):
+    name = name.lower()
+    if name.startswith('user') and name[4:].isdigit() and int(name[4:]) < settings['users']:
+        return int(name[4:])
+    return None
+
+
+def _flair(name):
+    """The flairlist entry for *name*, or None if there's no such user."""
+    with changed_lock:
+        if name.lower() in changed:
+            return dict(changed[name.lower()])
+    i = _user_index(name)
+    if i is None:
+        return None
+    text, css = flair_for(i)
+    return {'user': 'user{}'.format(i), 'flair_text': text, 'flair_css_class': css}
+
+
+def _set_flair(name, text, css):
+    entry = _flair(name)
+    if entry is None:
+        return False
+    entry.update(flair_text=text, flair_css_class=css)
+    with changed_lock:
+        changed[name.lower()] = entry
+    return True
+
+
+class _StripJson(object):
+    """praw asks for ``.json`` on some paths but not others; reddit doesn't mind either way."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'].endswith('.json'):
+            environ['PATH_INFO'] = environ['PATH_INFO'][:-len('.json')]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = _StripJson(app.wsgi_app)
+
+
+def _json(data, status=200):
+    return Response(json.dumps(data), status=status, mimetype='application/json')
+
+
+@app.before_request
+def _delay_and_fail():
+    delay = settings['latency'] + random.uniform(-settings['jitter'], settings['jitter'])
+    if delay > 0:
+        time.sleep(delay)
+    if random.random() < settings['errors']:
+        return _json({'error': 503}, status=503)
+
+
+@app.after_request
+def _ratelimit_headers(response):
+    # plenty left, so the app's own limiter is what's being tested
+    response.headers['X-Ratelimit-Remaining'] = '599'
+    response.headers['X-Ratelimit-Reset'] = str(600 - int(time.time()) % 600)
+    response.headers['X-Ratelimit-Used'] = '1'
+    return response
+
+
+@app.route('/api/v1/access_token/', methods=('POST',))
+def access_token():
+    return _json({'access_token': binascii.hexlify(os.urandom(16)).decode('ascii'),
+                  'token_type': 'bearer',
+                  'expires_in': 3600,
+                  'refresh_token': request.form.get('refresh_token', 'bench'),
+                  'scope': 'identity mysubreddits modflair flair'})
+
+
+@app.route('/api/v1/me')
+def me():
+    return _json({'name': MODERATOR, 'id': 'bench1', 'created_utc': 1300000000.0,
+                  'link_karma': 1, 'comment_karma': 1, 'is_mod': True})
+
+
+@app.route('/r/<subreddit>/about/moderators/')
+def moderators(subreddit):
+    return _json({'kind': 'UserList',
+                  'data': {'children': [{'name': MODERATOR, 'id': 't2_bench1', 'date': 1300000000.0,
+                                         'mod_permissions': ['all']}]}})
+
+
+@app.route('/subreddits/mine/moderator/')
+def my_moderation():
+    return _json({'kind': 'Listing',
+                  'data': {'after': None, 'before': None, 'modhash': None,
+                           'children': [{'kind': 't5',
+                                         'data': {'display_name': 'mindcrack', 'name': 't5_bench',
+                                                  'id': 'bench', 'url': '/r/mindcrack/'}}]}})
+
+
+@app.route('/r/<subreddit>/api/flairlist/')
+def flairlist(subreddit):
+    if request.args.get('name'):
+        entry = _flair(request.args['name'])
+        return _json({'users': [entry] if entry else [], 'next': None, 'prev': None})
+    limit = min(int(request.args.get('limit', 1000)), 1000)
+    after = request.args.get('after')
+    start = _user_index(after) + 1 if after and _user_index(after) is not None else 0
+    users = [_flair('user{}'.format(i)) for i in range(start, min(start + limit, settings['users']))]
+    more = start + limit < settings['users']
+    return _json({'users': users, 'next': users[-1]['user'] if more else None, 'prev': None})
+
+
+@app.route('/api/flair/', methods=('POST',))
+def flair():
+    if not _set_flair(request.form['name'], request.form.get('text', ''), request.form.get('css_class', '')):
+        return _json({'json': {'errors': [['USER_DOESNT_EXIST', "that user doesn't exist", 'name']]}})
+    return _json({'json': {'errors': []}})
+
+
+@app.route('/api/flaircsv/', methods=('POST',))
+def flaircsv():
+    results = []
+    for row in request.form['flair_csv'].splitlines():
+        name, text, css = (row.split(',') + ['', ''])[:3]
+        if _set_flair(name, text, css):
+            results.append({'ok': True, 'status': 'added flair for user {}'.format(name),
+                            'warnings': {}, 'errors': {}})
+        else:
+            results.append({'ok': False, 'status': 'skipped',
+                            'warnings': {}, 'errors': {'user': 'unable to resolve user `{}`'.format(name)}})
+    return _json(results)
+
+
+STYLESHEET = ''.join(
+    '.flair-{css}{{background-position:0 -{offset}px}}\n'.format(css=flair_for(n)[1], offset=n * 16)
+    for n in range(FLAIRS)) + '.side{width:300px}\n.flair{display:inline-block;height:16px}\n'
+STYLESHEET_ETAG = '"{}"'.format(binascii.hexlify(os.urandom(8)).decode('ascii'))
+
+
+@app.route('/r/<subreddit>/stylesheet.css')
+def stylesheet(subreddit):
+    if request.headers.get('If-None-Match') == STYLESHEET_ETAG:
+        return Response(status=304)
+    response = Response(STYLESHEET, mimetype='text/css')
+    response.headers['ETag'] = STYLESHEET_ETAG
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds')
+    parser.add_argument('--jitter', type=float, default=0, help='milliseconds')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of requests that fail')
+    args = parser.parse_args()
+    settings.update(users=args.users, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                    errors=args.errors)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app.run('127.0.0.1', args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
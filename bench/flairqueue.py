@@ -0,0 +1,148 @@
+"""Check the flair queue's ordering, and time it.
+
+    python bench/flairqueue.py [--db URL] [--redis URL] [--writes N]
+
+Creates a fresh database (a temporary SQLite file unless ``--db`` is given; a database given here
+is emptied first!) and runs the flair_writes job against a stand-in for reddit's set_flair_csv,
+which fails when told to. First it checks that a user whose write is waiting to be retried can't
+be given that older flair after a newer write has gone through, nor ahead of a newer write that is
+itself waiting. Then it times flushing *N* writes, a tenth of them superseding older ones still
+queued.
+
+Redis database 15 is used, and flushed, unless ``--redis`` says otherwise.
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CONFIG = """
+SQLALCHEMY_DATABASE_URI = {db!r}
+REDIS_URL = CACHE_REDIS_URL = {redis!r}
+"""
+
+
+class FakeReddit(object):
+    def __init__(self):
+        self.failing = False
+        self.sent = []
+        self.calls = 0
+
+    def set_flair_csv(self, subreddit, rows):
+        if self.failing:
+            raise RuntimeError('reddit is down')
+        self.calls += 1
+        self.sent.extend((row['user'], row['flair_text']) for row in rows)
+        return [{'ok': True} for _ in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='SQLAlchemy URL (default: a temporary SQLite file)')
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--writes', type=int, default=5000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='flairbot-bench-')
+    config = os.path.join(tmp, 'bench.cfg')
+    with open(config, 'w') as f:
+        f.write(CONFIG.format(db=args.db or 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+                              redis=args.redis))
+    os.environ['FLAIRBOT_SETTINGS'] = config
+
+    sys.path.insert(0, ROOT)
+    from flairbot.app import app, db
+    from flairbot.models import FlairWrite
+    from flairbot import flairqueue, reddit, shared
+
+    fake = FakeReddit()
+    reddit.get = lambda **kw: fake
+    reddit.get_flairs = lambda names, no_cache=False: {name: None for name in names}
+    shared.store.flushdb()
+    problems = []
+
+    def write(user, text):
+        flairqueue.enqueue([{'user': user, 'flair_text': text, 'flair_css_class': ''}])
+        db.session.commit()
+
+    def make_due():
+        FlairWrite.query.filter(FlairWrite.applied == None).update(
+            {'next_attempt': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)},
+            synchronize_session=False)
+        db.session.commit()
+
+    def check(what, expected):
+        if fake.sent != expected:
+            problems.append('{}: sent {}, expected {}'.format(what, fake.sent, expected))
+        del fake.sent[:]
+
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            # an older write waiting for a retry is superseded by a newer one that goes through
+            fake.failing = True
+            write('alice', 'A')
+            flairqueue.flair_writes()
+            fake.failing = False
+            write('alice', 'B')
+            flairqueue.flair_writes()
+            make_due()
+            flairqueue.flair_writes()
+            check('newer write applied first', [('alice', 'B')])
+
+            # an older write coming due doesn't jump ahead of a newer one that is still waiting
+            fake.failing = True
+            write('bob', 'A')
+            flairqueue.flair_writes()
+            write('bob', 'B')
+            flairqueue.flair_writes()
+            fake.failing = False
+            FlairWrite.query.filter(FlairWrite.user == 'bob', FlairWrite.flair_text == 'A').update(
+                {'next_attempt': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)},
+                synchronize_session=False)
+            db.session.commit()
+            flairqueue.flair_writes()
+            check('older write due before a waiting newer one', [])
+            make_due()
+            flairqueue.flair_writes()
+            check('waiting newer write sent', [('bob', 'B')])
+            left = FlairWrite.query.filter(FlairWrite.applied == None, FlairWrite.failed == False).count()
+            if left:
+                problems.append('{} writes left unapplied'.format(left))
+
+            fake.failing = True
+            for i in range(0, args.writes, 10):
+                write('user{}'.format(i), 'old')
+            flairqueue.flair_writes()
+            fake.failing = False
+            for i in range(args.writes):
+                flairqueue.enqueue([{'user': 'user{}'.format(i), 'flair_text': 'new', 'flair_css_class': ''}])
+            db.session.commit()
+            fake.calls = 0
+            t = time.time()
+            flairqueue.flair_writes()
+            elapsed = time.time() - t
+            if sorted(set(fake.sent)) != sorted(('user{}'.format(i), 'new') for i in range(args.writes)):
+                problems.append('bulk flush sent the wrong writes')
+            db.session.remove()
+    finally:
+        shutil.rmtree(tmp)
+
+    print('ordering: {}'.format('ok' if not problems else 'WRONG'))
+    for problem in problems:
+        print('  ' + problem)
+    print('flush: {} writes in {:.0f} ms ({} set_flair_csv calls)'.format(
+        args.writes, elapsed * 1000, fake.calls))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""Load-test the app under uWSGI, against bench/fakereddit.py.
+
+    python bench/load.py [--db URL] [-w WORKERS] [-c CONCURRENCY] [-d SECONDS] [-o results.json]
+    python bench/load.py --compare old.json new.json
+
+Starts the fake reddit, creates a fresh database (a temporary SQLite file unless ``--db`` is
+given; a MySQL database given here is emptied first!) and runs the app under uWSGI with its mule.
+Then *CONCURRENCY* clients each repeat, for *SECONDS*:
+
+* ``trade_new``: a user who hasn't traded yet opens the form and asks for another user's flair;
+* ``trade_view``: that other user looks at the trade;
+* ``trade_accept``: and accepts it.
+
+Every ``--giveaway-every`` seconds a giveaway is created and ``--giveaway-burst`` users try to
+claim it at once (``giveaway_accept``). Nobody logs in: the clients forge session cookies with
+the benchmark's secret key. Afterwards every giveaway is checked: each copy should have gone to
+exactly one claimant, and no claim should have failed (concurrent claims used to deadlock on
+MySQL). If not, it says so and exits non-zero.
+
+Requests per second and p50/p99 latency for each endpoint are printed and written, with the
+commit and settings, to a JSON file (``bench/results/<commit>-<database>.json`` by default).
+``--compare`` prints two such files side by side.
+
+Redis database 15 is used, and flushed, unless ``--redis`` says otherwise. Needs uwsgi on the
+PATH.
+"""
+
+import argparse
+import binascii
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from fakereddit import flair_for  # noqa: E402
+
+CONFIG = """
+SECRET_KEY = {secret!r}
+SQLALCHEMY_DATABASE_URI = {db!r}
+REDIS_URL = CACHE_REDIS_URL = {redis!r}
+REDDIT_URL = {reddit!r}
+REDDIT_CLIENT_ID = 'bench'
+REDDIT_CLIENT_SECRET = 'bench'
+REDDIT_REDIRECT_URI = 'http://127.0.0.1/'
+REDDIT_REFRESH_TOKEN = 'bench'
+REDDIT_RATE = 100000.0
+REDDIT_BURST = 100000
+WTF_CSRF_ENABLED = False
+"""
+
+
+class Users(object):
+    """Hands out users who haven't traded yet, so everyone's flair is still what flair_for says."""
+
+    def __init__(self, count):
+        self.count = count
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.next >= self.count:
+                raise RuntimeError('ran out of users; raise --users')
+            self.next += 1
+            return self.next - 1
+
+
+class Recorder(object):
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Client(object):
+    def __init__(self, base, serializer, recorder):
+        self.base = base
+        self.serializer = serializer
+        self.recorder = recorder
+
+    def request(self, endpoint, user, method, path, **kw):
+        cookie = self.serializer.dumps({
+            'REDDIT_USER': user,
+            'REDDIT_CREDENTIALS': {'scope': ['identity'], 'access_token': 'bench', 'refresh_token': None}})
+        start = time.time()
+        try:
+            # a new connection every time: uWSGI's http-socket doesn't do keep-alive
+            r = requests.request(method, self.base + path, cookies={'session': cookie},
+                                 allow_redirects=False, timeout=60, **kw)
+            ok = r.status_code < 400
+        except requests.RequestException:
+            r, ok = None, False
+        self.recorder.record(endpoint, time.time() - start, ok)
+        return r
+
+    def trade(self, users):
+        creator, acceptor = 'user{}'.format(users.take()), users.take()
+        want_text = flair_for(acceptor)[0]
+        acceptor = 'user{}'.format(acceptor)
+        self.request('trade_new', creator, 'GET', '/t/new/')
+        r = self.request('trade_new', creator, 'POST', '/t/new/',
+                         data={'want_flair': want_text, 'trade_with': '', 'special_warning': 'yes'})
+        match = r is not None and re.search(r'/t/([0-9a-f]{32})/', r.text)
+        if not match:
+            return
+        trade_id = match.group(1)
+        self.request('trade_view', acceptor, 'GET', '/t/{}/'.format(trade_id))
+        self.request('trade_accept', acceptor, 'POST', '/t/{}/accept'.format(trade_id),
+                     data={'act_id': trade_id, 'special_warning': 'yes'})
+
+    def claim(self, user, trade_id):
+        self.request('giveaway_accept', user, 'POST', '/t/{}/accept'.format(trade_id),
+                     data={'act_id': trade_id})
+
+
+def create_giveaway(app_modules, users, count):
+    db, Trade = app_modules
+    i = users.take()
+    text, css = flair_for(i)
+    trade = Trade(creator='user{}'.format(i), creator_flair=text, creator_flair_css=css)
+    trade.status = 'giveaway'
+    trade.giveaway_count = count
+    db.session.add(trade)
+    db.session.commit()
+    trade_id = trade.id.decode('ascii') if isinstance(trade.id, bytes) else trade.id
+    db.session.remove()
+    return trade_id
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("{} didn't come up".format(url))
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        endpoints[endpoint] = {'requests': len(samples),
+                               'errors': recorder.errors.get(endpoint, 0),
+                               'rps': len(samples) / elapsed,
+                               'p50_ms': percentile(samples, 50) * 1000,
+                               'p99_ms': percentile(samples, 99) * 1000}
+    return endpoints
+
+
+def print_table(rows):
+    print('{:16} {:>9} {:>7} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for endpoint, s in sorted(rows.items()):
+        print('{:16} {:9d} {:7d} {:9.1f} {:9.1f} {:9.1f}'.format(
+            endpoint, s['requests'], s['errors'], s['rps'], s['p50_ms'], s['p99_ms']))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{} ({}) -> {} ({})'.format(old['commit'][:10], old['database'], new['commit'][:10], new['database']))
+    print('{:16} {:>19} {:>19} {:>19}'.format('endpoint', 'req/s', 'p50 ms', 'p99 ms'))
+    for endpoint in sorted(set(old['endpoints']) | set(new['endpoints'])):
+        a, b = old['endpoints'].get(endpoint), new['endpoints'].get(endpoint)
+        if a is None or b is None:
+            print('{:16} (only in {})'.format(endpoint, old_path if b is None else new_path))
+            continue
+        print('{:16} {:>19} {:>19} {:>19}'.format(endpoint, *[
+            '{:.1f} -> {:.1f}'.format(a[k], b[k]) for k in ('rps', 'p50_ms', 'p99_ms')]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='SQLAlchemy URL (default: a temporary SQLite file)')
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='uWSGI workers')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--latency', type=float, default=50, help="fake reddit's latency, ms")
+    parser.add_argument('--jitter', type=float, default=20, help='ms')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of reddit requests that fail')
+    parser.add_argument('--giveaway-every', type=float, default=5, help='seconds; 0 for none')
+    parser.add_argument('--giveaway-burst', type=int, default=20)
+    parser.add_argument('--app-port', type=int, default=5081)
+    parser.add_argument('--reddit-port', type=int, default=8081)
+    parser.add_argument('-o', '--output')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    tmp = tempfile.mkdtemp(prefix='flairbot-bench-')
+    database = args.db or 'sqlite:///' + os.path.join(tmp, 'bench.db')
+    secret = binascii.hexlify(os.urandom(16)).decode('ascii')
+    config = os.path.join(tmp, 'bench.cfg')
+    with open(config, 'w') as f:
+        f.write(CONFIG.format(secret=secret, db=database, redis=args.redis,
+                              reddit='http://127.0.0.1:{}'.format(args.reddit_port)))
+    os.environ['FLAIRBOT_SETTINGS'] = config
+
+    sys.path.insert(0, ROOT)
+    from flairbot.app import app, db
+    from flairbot.models import GiveawayLog, Trade
+    from flairbot import shared
+    shared.store.flushdb()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+    flask_app = Flask('bench')
+    flask_app.secret_key = secret
+    serializer = SecureCookieSessionInterface().get_signing_serializer(flask_app)
+
+    children = [
+        subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'fakereddit.py'),
+                          '-p', str(args.reddit_port), '--users', str(args.users),
+                          '--latency', str(args.latency), '--jitter', str(args.jitter),
+                          '--errors', str(args.errors)]),
+        subprocess.Popen(['uwsgi', '--http-socket', '127.0.0.1:{}'.format(args.app_port),
+                          '--chdir', ROOT, '--module', 'wsgi:app', '--master',
+                          '--workers', str(args.workers), '--mule=mule.py', '--enable-threads',
+                          '--die-on-term', '--disable-logging'],
+                         cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+    ]
+    try:
+        base = 'http://127.0.0.1:{}'.format(args.app_port)
+        wait_for('http://127.0.0.1:{}/api/v1/me'.format(args.reddit_port))
+        wait_for(base + '/')
+
+        users = Users(args.users)
+        recorder = Recorder()
+        created = []
+        stop = time.time() + args.duration
+
+        def trader():
+            client = Client(base, serializer, recorder)
+            while time.time() < stop:
+                client.trade(users)
+
+        def giveaways():
+            while args.giveaway_every and time.time() + args.giveaway_every < stop:
+                time.sleep(args.giveaway_every)
+                with app.app_context():
+                    trade_id = create_giveaway((db, Trade), users, args.giveaway_burst // 2)
+                created.append(trade_id)
+                burst = [threading.Thread(target=Client(base, serializer, recorder).claim,
+                                          args=('user{}'.format(users.take()), trade_id))
+                         for _ in range(args.giveaway_burst)]
+                for t in burst:
+                    t.start()
+                for t in burst:
+                    t.join()
+
+        start = time.time()
+        threads = [threading.Thread(target=trader) for _ in range(args.concurrency)]
+        threads.append(threading.Thread(target=giveaways))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        problems = []
+        if recorder.errors.get('giveaway_accept'):
+            problems.append('{} claims failed'.format(recorder.errors['giveaway_accept']))
+        with app.app_context():
+            for trade_id in created:
+                left = Trade.query.get(trade_id).giveaway_count
+                claimed = GiveawayLog.query.filter(GiveawayLog.trade_id == trade_id).count()
+                if (left, claimed) != (0, args.giveaway_burst // 2):
+                    problems.append('giveaway {}: {} claimed, {} left of {}'.format(
+                        trade_id, claimed, left, args.giveaway_burst // 2))
+            db.session.remove()
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        shutil.rmtree(tmp)
+
+    endpoints = summarize(recorder, elapsed)
+    print_table(endpoints)
+    print('giveaways: {}'.format('ok ({})'.format(len(created)) if not problems else 'WRONG'))
+    for problem in problems[:10]:
+        print('  ' + problem)
+
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT).strip())
+    dialect = database.split(':', 1)[0].split('+', 1)[0]
+    results = {'commit': commit,
+               'dirty': dirty,
+               'database': dialect,
+               'when': datetime.datetime.utcnow().isoformat() + 'Z',
+               'elapsed': elapsed,
+               'settings': {k: v for k, v in vars(args).items() if k not in ('db', 'output', 'compare')},
+               'endpoints': endpoints}
+    output = args.output or os.path.join(ROOT, 'bench', 'results', '{}-{}.json'.format(commit[:10], dialect))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to {}'.format(output))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
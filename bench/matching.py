@@ -0,0 +1,139 @@
+"""Benchmark the trade matcher.
+
+    python bench/matching.py [--db URL] [--trades N] [--flairs F] [--new M] [--cycle-length K]
+
+Creates a fresh database (a temporary SQLite file unless ``--db`` is given; a database given here
+is emptied first!) holding *N* open trades between *F* flairs. What people want is skewed towards
+a few popular flairs, as it is on the subreddit. Then it times:
+
+* ``find_pair`` for *M* new trades, each in the transaction that saves it as in ``trade_new``,
+  which is all the matching a new trade costs;
+* a ``find_cycles`` sweep over every open trade: reading them, building the ``MatchIndex`` and
+  taking cycles out of it (nothing is written).
+"""
+
+import argparse
+import binascii
+import bisect
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CONFIG = """
+SQLALCHEMY_DATABASE_URI = {db!r}
+"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Flairs(object):
+    """Flair names, offered evenly and wanted with Zipf-ish popularity."""
+
+    def __init__(self, count, rng):
+        self.names = ['Flair {}'.format(i) for i in range(count)]
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(count):
+            total += 1.0 / (rank + 1)
+            self.cumulative.append(total)
+
+    def offer(self):
+        return self.rng.choice(self.names)
+
+    def want(self, offer):
+        while True:
+            i = bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+            want = self.names[min(i, len(self.names) - 1)]
+            if want != offer:
+                return want
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='SQLAlchemy URL (default: a temporary SQLite file)')
+    parser.add_argument('--trades', type=int, default=50000, help='open trades to start with')
+    parser.add_argument('--flairs', type=int, default=500)
+    parser.add_argument('--new', type=int, default=2000, help='new trades to match')
+    parser.add_argument('--cycle-length', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='flairbot-bench-')
+    config = os.path.join(tmp, 'bench.cfg')
+    with open(config, 'w') as f:
+        f.write(CONFIG.format(db=args.db or 'sqlite:///' + os.path.join(tmp, 'bench.db')))
+    os.environ['FLAIRBOT_SETTINGS'] = config
+
+    sys.path.insert(0, ROOT)
+    from flairbot.app import app, db
+    from flairbot.models import Trade
+    from flairbot import matching
+
+    rng = random.Random(args.seed)
+    flairs = Flairs(args.flairs, rng)
+    start = datetime.datetime(2026, 1, 1)
+
+    def row(i):
+        offer = flairs.offer()
+        return {'id': binascii.hexlify(os.urandom(16)).decode('ascii'), 'status': 'valid',
+                'deleted': False, 'creator': 'user{}'.format(i), 'creator_flair': offer,
+                'creator_flair_css': 'f' + offer.split()[1], 'target_flair': flairs.want(offer),
+                'created': start + datetime.timedelta(seconds=i)}
+
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            for first in range(0, args.trades, 5000):
+                db.session.execute(Trade.__table__.insert(),
+                                   [row(i) for i in range(first, min(first + 5000, args.trades))])
+            db.session.commit()
+
+            timings = []
+            pairs = 0
+            for i in range(args.trades, args.trades + args.new):
+                values = row(i)
+                trade = Trade(creator=values['creator'], creator_flair=values['creator_flair'],
+                              creator_flair_css=values['creator_flair_css'])
+                trade.target_flair = values['target_flair']
+                db.session.add(trade)
+                db.session.flush()
+                t = time.time()
+                if matching.find_pair(trade) is not None:
+                    pairs += 1
+                timings.append(time.time() - t)
+                db.session.commit()
+
+            t = time.time()
+            index = matching.MatchIndex()
+            for trade_id, creator, offer, want in matching.query_open_columns():
+                index.add(trade_id, creator, offer, want)
+            loaded = time.time() - t
+            t = time.time()
+            cycles = index.cycles(3, args.cycle_length)
+            searched = time.time() - t
+    finally:
+        shutil.rmtree(tmp)
+
+    ms = [x * 1000 for x in timings]
+    print('{} open trades, {} flairs, {}'.format(args.trades, args.flairs, db.engine.dialect.name
+                                                 if args.db else 'sqlite'))
+    print('find_pair: {} new trades, {} paired; mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'
+          .format(len(ms), pairs, sum(ms) / len(ms), percentile(ms, 50), percentile(ms, 99), max(ms)))
+    print('find_cycles: read and indexed {} trades in {:.0f} ms; found {} cycles of up to {} in {:.0f} ms'
+          .format(args.trades + args.new, loaded * 1000, len(cycles), args.cycle_length, searched * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Compare flairbot.css.flair_rules with the cssutils code it replaced.
+
+    python bench/stylesheet.py [captured.css] [-n ROUNDS]
+
+Without a file, the live /r/mindcrack stylesheet is fetched. Both extractors are timed, and their
+output is checked for equivalence by parsing each with cssutils and comparing the rules. (The
+old code kept comments and emitted a rule once per matching selector; neither matters to a
+browser, so comments and duplicates are ignored.) ``TRICKY``, a few things the sheet may not
+happen to contain, is checked the same way.
+
+Needs cssutils, which the app itself no longer uses.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+import cssutils
+import cssutils.css
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flairbot.css import flair_rules  # noqa: E402
+
+
+TRICKY = '''
+.flair-a { background: url(a}b) no-repeat }
+.flair-b { background: URL( "c}d" ) }
+.flair-c:not(.x), content { color: rgb(1, 2, 3) }
+@media (max-width: 100px) { .flair-d { color: red } }
+.flair-e { content: "}" /* } */ }
+'''
+
+
+def legacy(text):
+    sheet = cssutils.parseString(text)
+    new = cssutils.css.CSSStyleSheet()
+    for rule in sheet.cssRules.rulesOfType(cssutils.css.CSSRule.STYLE_RULE):
+        for selector in rule.selectorList:
+            if selector.selectorText == 'content':
+                selector.selectorText = '.flair'
+            if selector.selectorText.startswith('.flair'):
+                new.add(rule)
+    return new.cssText.decode('utf8')
+
+
+def normalize(text):
+    cssutils.ser.prefs.keepComments = False
+    rules = []
+    for rule in cssutils.parseString(text).cssRules.rulesOfType(cssutils.css.CSSRule.STYLE_RULE):
+        item = (rule.selectorText, rule.style.cssText)
+        if item not in rules:
+            rules.append(item)
+    return rules
+
+
+def compare(name, text):
+    old_rules, new_rules = normalize(legacy(text)), normalize(flair_rules(text))
+    if old_rules == new_rules:
+        print('{}: equivalent ({} rules)'.format(name, len(new_rules)))
+        return True
+    print('{}: DIFFERENT'.format(name))
+    for rule in [r for r in old_rules if r not in new_rules][:10]:
+        print('  only in cssutils: {} {{{}}}'.format(*rule))
+    for rule in [r for r in new_rules if r not in old_rules][:10]:
+        print('  only in flair_rules: {} {{{}}}'.format(*rule))
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sheet', nargs='?')
+    parser.add_argument('-n', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.sheet:
+        with open(args.sheet) as f:
+            text = f.read()
+    else:
+        text = requests.get('https://www.reddit.com/r/mindcrack/stylesheet.css',
+                            headers={'User-Agent': 'flairbot stylesheet benchmark'}).text
+    print('stylesheet: {} bytes'.format(len(text)))
+
+    cssutils.log.setLevel(logging.CRITICAL)
+    same = compare('output', text)
+    same = compare('tricky cases', TRICKY) and same
+
+    for name, fn in (('cssutils', legacy), ('flair_rules', flair_rules)):
+        t = min(timeit.repeat(lambda: fn(text), number=1, repeat=args.rounds))
+        print('{:12} {:10.2f} ms'.format(name, t * 1000))
+
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
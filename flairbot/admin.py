@@ -1,9 +1,14 @@
+from flask import make_response, redirect, request, url_for
 from flask.ext.admin import Admin, BaseView, expose
 from flask.ext.admin.contrib.sqla import ModelView
+from flask_wtf import Form
+
+from wtforms.fields import IntegerField, SelectField
+from wtforms.validators import NumberRange
 
 from sqlalchemy.sql import and_, or_, not_
 
-from . import reddit, utils
+from . import browse, profiler, reddit, shared, utils
 from .app import app, cache, db
 from .models import GiveawayLog, Trade
 
@@ -18,6 +23,14 @@ class AuthenticatedModelView(ModelView):
         return utils.is_admin()
 
 
+class TradeModelView(AuthenticatedModelView):
+    def after_model_change(self, form, model, is_created):
+        browse.changed()
+
+    def after_model_delete(self, model):
+        browse.changed()
+
+
 ######
 
 
@@ -28,7 +41,8 @@ class IndexView(AuthenticatedView):
         myflair = reddit.get_flair(me)
         myflair = utils.render_flair(myflair['flair_text'], myflair['flair_css_class'])
         mymod = ', '.join(sorted(reddit.get_my_moderation()))
-        return self.render('admin/index.html', me=me, myflair=myflair, mymod=mymod)
+        counters = sorted(shared.counters().items())
+        return self.render('admin/index.html', me=me, myflair=myflair, mymod=mymod, counters=counters)
 
 
 class ListView(AuthenticatedView):
@@ -37,28 +51,179 @@ class ListView(AuthenticatedView):
         self.filter = filter_
         super(ListView, self).__init__(**kw)
 
+    def approximate_count(self):
+        # counting is the slow part of paging, so only do it every so often
+        key = 'admin_count_' + self.endpoint
+        count = cache.get(key)
+        if count is None:
+            count = Trade.query.filter(self.filter).count()
+            cache.set(key, count, timeout=app.config['CACHE_TIME_SHORT'])
+        return count
+
     @expose('/')
-    @expose('/p/<int:page>')
-    def index(self, page=1):
-        trades = Trade.query.filter(self.filter).order_by(self.order).paginate(page, 50)
-        return self.render('admin/log.html', trades=trades)
+    def index(self):
+        trades = utils.keyset_page(Trade.query.filter(self.filter), self.order, Trade.id,
+                                   older=request.args.get('older'), newer=request.args.get('newer'))
+        return self.render('admin/log.html', trades=trades, count=self.approximate_count())
+
+
+# Flask-Cache keys, without the prefix. Anything memoized is a hash of its arguments, so it goes
+# under whatever isn't otherwise accounted for.
+_cache_families = [
+    ('stylesheet', 'reddit_stylesheet*', lambda k: k.startswith('reddit_stylesheet')),
+    ('moderators', 'reddit_*_cache', lambda k: k.startswith('reddit_') and k.endswith('_cache')),
+    ('memo versions', '*_memver', lambda k: k.endswith('_memver')),
+    ('admin', 'admin_*', lambda k: k.startswith('admin_')),
+    ('browse', 'browse_*', lambda k: k.startswith('browse_')),
+    ('no flair', 'flairmissing:*', lambda k: k.startswith('flairmissing:')),
+    ('flair', 'flair:*', lambda k: k.startswith('flair:')),
+    ('other', '*', lambda k: True),
+]
+_families = [name for name, _, _ in _cache_families] + ['shared']
+
+
+def _cache_family(key):
+    for name, _, test in _cache_families:
+        if test(key):
+            return name
+
+
+def _scan(client, match, cursor, count):
+    """SCAN until there are about *count* keys or the end. Each SCAN call does a bounded amount of
+    work, so redis keeps serving everyone else in between."""
+    keys = []
+    for _ in range(50):
+        cursor, batch = client.scan(cursor, match=match, count=count)
+        keys.extend(k.decode('utf8') for k in batch)
+        if int(cursor) == 0 or len(keys) >= count:
+            break
+    return int(cursor), keys
+
+
+def _describe(client, keys):
+    """Type, milliseconds to live and bytes used for each of *keys*, pipelined."""
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+        pipe.pttl(key)
+        pipe.execute_command('MEMORY', 'USAGE', key)
+    results = pipe.execute(raise_on_error=False)
+    described = []
+    for i in range(0, len(results), 3):
+        type_, ttl, size = results[i:i + 3]
+        if isinstance(type_, bytes):
+            type_ = type_.decode('utf8')
+        described.append((type_, ttl if isinstance(ttl, int) and ttl >= 0 else None,
+                          size if isinstance(size, int) else None))
+    return described
 
 
 class CacheView(AuthenticatedView):
+    page_size = 100
+
+    def _source(self, family):
+        if family == 'shared':
+            return shared.store, shared.KEY_PREFIX + '*', ''
+        prefix = cache.cache.key_prefix
+        match = '*'
+        for name, pattern, _ in _cache_families:
+            if name == family:
+                match = pattern
+        return cache.cache._client, prefix + match, prefix
+
     @expose('/')
     def index(self):
-        keymap = {}
-        keys = cache.cache._client.keys(cache.cache.key_prefix + '*')
-        l = len(cache.cache.key_prefix)
-        for key in keys:
-            key = key.decode('utf8')[l:]
-            keymap[key] = cache.get(key)
+        family = request.args.get('family', 'flair')
+        if family not in _families:
+            family = 'flair'
+        cursor = request.args.get('cursor', 0, type=int)
+        client, match, prefix = self._source(family)
+        cursor, keys = _scan(client, match, cursor, self.page_size)
+        if family != 'shared':
+            keys = [k for k in keys if _cache_family(k[len(prefix):]) == family]
+        described = _describe(client, keys)
+        values = client.mget(keys) if keys else []
+        rows = []
+        for key, (type_, ttl, size), value in zip(keys, described, values):
+            if type_ != 'string':
+                value = '({})'.format(type_)
+            elif prefix:
+                value = cache.cache.load_object(value)
+            rows.append((key[len(prefix):], ttl, size, value))
         def _repr(v):
             if isinstance(v, dict) and 'flair_text' in v:
                 return utils.render_flair(v['flair_text'], v.get('flair_css_class', None))
             else:
-                return repr(v)
-        return self.render('admin/cache.html', mapping=sorted(keymap.items()), repr=_repr)
+                return repr(v)[:200]
+        return self.render('admin/cache.html', rows=rows, repr=_repr, family=family,
+                           families=_families, cursor=cursor, page_bytes=sum(r[2] or 0 for r in rows))
+
+    @expose('/usage')
+    def usage(self):
+        """Keys and bytes per family, over the whole keyspace. Cached, as it has to look at
+        everything."""
+        usage = None if request.args.get('refresh') else cache.get('admin_cache_usage')
+        if usage is None:
+            usage = {}
+            # no family matches None, so that's every Flask-Cache key
+            for client, match, prefix in (self._source(None), self._source('shared')):
+                cursor = 0
+                while True:
+                    cursor, keys = _scan(client, match, cursor, 1000)
+                    for key, (_, _, size) in zip(keys, _describe(client, keys)):
+                        name = _cache_family(key[len(prefix):]) if prefix else 'shared'
+                        entry = usage.setdefault(name, [0, 0])
+                        entry[0] += 1
+                        entry[1] += size or 0
+                    if cursor == 0:
+                        break
+            usage = sorted(usage.items())
+            cache.set('admin_cache_usage', usage, timeout=app.config['CACHE_TIME_SHORT'])
+        return self.render('admin/cache_usage.html', usage=usage)
+
+
+class ActionForm(Form):
+    pass
+
+
+class ProfileForm(Form):
+    percent = IntegerField('Percent of requests', default=10, validators=[NumberRange(1, 100)])
+    endpoint = SelectField('Endpoint', default='')
+    minutes = IntegerField('For (minutes)', default=5, validators=[NumberRange(1, 60)])
+
+
+class ProfileView(AuthenticatedView):
+    @expose('/', methods=('GET', 'POST'))
+    def index(self):
+        form = ProfileForm()
+        form.endpoint.choices = [('', 'any')] + [(e, e) for e in sorted(app.view_functions)]
+        if form.validate_on_submit():
+            profiler.start(form.percent.data, form.minutes.data * 60, form.endpoint.data)
+            return redirect(url_for('.index'))
+        requests, samples = profiler.totals()
+        return self.render('admin/profile.html', form=form, action_form=ActionForm(),
+                           session=profiler.session(), stacks=profiler.stacks()[:30],
+                           requests=requests, samples=samples,
+                           interval=app.config['PROFILE_INTERVAL'])
+
+    @expose('/stop', methods=('POST',))
+    def stop(self):
+        if ActionForm().validate_on_submit():
+            profiler.stop()
+        return redirect(url_for('.index'))
+
+    @expose('/clear', methods=('POST',))
+    def clear(self):
+        if ActionForm().validate_on_submit():
+            profiler.clear()
+        return redirect(url_for('.index'))
+
+    @expose('/collapsed.txt')
+    def collapsed(self):
+        response = make_response(profiler.collapsed())
+        response.mimetype = 'text/plain'
+        response.headers['Content-Disposition'] = 'attachment; filename=flairbot-profile.txt'
+        return response
 
 
 class GiveawayLogView(AuthenticatedModelView):
@@ -73,9 +238,10 @@ class GiveawayLogView(AuthenticatedModelView):
 ######
 
 admin = Admin(app, index_view=IndexView('Home', None, 'admin', '/admin', 'static'))
-admin.add_view(ListView(Trade.finalized.desc(), and_(Trade.status == 'finished', Trade.deleted == False), name='Log', category='Trades', endpoint='trades-log'))
-admin.add_view(ListView(Trade.created.desc(), and_(or_(Trade.status == 'valid', Trade.status == 'giveaway'), Trade.deleted == False), name='Open', category='Trades', endpoint='trades-open'))
-admin.add_view(ListView(Trade.created.desc(), or_(Trade.deleted == True, Trade.status == 'invalid'), name='Invalid/Deleted', category='Trades', endpoint='trades-deleted'))
-admin.add_view(AuthenticatedModelView(Trade, db.session, name='Database Model', category='Trades', endpoint='trades-db'))
+admin.add_view(ListView(Trade.finalized, and_(Trade.status == 'finished', Trade.deleted == False), name='Log', category='Trades', endpoint='trades-log'))
+admin.add_view(ListView(Trade.created, and_(or_(Trade.status == 'valid', Trade.status == 'giveaway'), Trade.deleted == False), name='Open', category='Trades', endpoint='trades-open'))
+admin.add_view(ListView(Trade.created, or_(Trade.deleted == True, Trade.status == 'invalid'), name='Invalid/Deleted', category='Trades', endpoint='trades-deleted'))
+admin.add_view(TradeModelView(Trade, db.session, name='Database Model', category='Trades', endpoint='trades-db'))
 admin.add_view(GiveawayLogView(GiveawayLog, db.session, name='Giveaways', endpoint='giveaway-db'))
 admin.add_view(CacheView('Cache', endpoint='cache'))
+admin.add_view(ProfileView('Profile', endpoint='profile'))
@@ -13,6 +13,7 @@ except ImportError:
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_pyfile('default.cfg')
 app.config.from_pyfile('config.cfg', silent=True)
+app.config.from_envvar('FLAIRBOT_SETTINGS', silent=True)
 
 cache = Cache(app)
 
@@ -26,4 +27,4 @@ if not app.debug:
     handler.setLevel(logging.INFO)
     app.logger.addHandler(handler)
 
-from . import admin, views, utils
+from . import admin, metrics, profiler, views, utils
@@ -0,0 +1,65 @@
+"""The public list of open trades, searchable by the flair offered or wanted.
+
+Anyone can look, logged in or not, so each page of results is rendered once and kept in the cache
+for ``BROWSE_CACHE_TIME`` seconds. Cached pages are keyed by a generation number in redis, which
+``changed`` bumps whenever a trade is opened or closed; pages from older generations are never read
+again, and expire by themselves.
+"""
+
+from flask import render_template
+from markupsafe import Markup
+
+import hashlib
+import json
+
+import redis
+
+from . import metrics, shared, utils
+from .app import app, cache
+from .models import Trade
+
+logger = app.logger.getChild('browse')
+
+PER_PAGE = 50
+
+_generation_key = shared.key('browse', 'generation')
+
+
+def generation():
+    """The current generation, or None if redis can't say (so nothing should be cached)."""
+    try:
+        return int(shared.store.get(_generation_key) or 0)
+    except redis.RedisError:
+        return None
+
+
+def changed():
+    """Call after committing anything that opens a trade, or closes an open one."""
+    try:
+        shared.store.incr(_generation_key)
+    except redis.RedisError:
+        logger.exception("couldn't bump the browse generation; results may be stale for a while")
+
+
+def _render(offer, offer_css, want, older, newer):
+    trades = utils.keyset_page(Trade.query_open(offer, offer_css, want), Trade.created, Trade.id,
+                               older=older, newer=newer, per_page=PER_PAGE)
+    search = {k: v for k, v in (('offer', offer), ('css', offer_css), ('want', want)) if v}
+    return render_template('browse_results.html', trades=trades, search=search)
+
+
+def results(offer=None, offer_css=None, want=None, older=None, newer=None):
+    """A page of open trades matching the search, as HTML."""
+    gen = generation()
+    if gen is None:
+        return Markup(_render(offer, offer_css, want, older, newer))
+    args = json.dumps([offer, offer_css, want, older, newer])
+    key = 'browse_{}_{}'.format(gen, hashlib.sha1(args.encode('utf8')).hexdigest())
+    fragment = cache.get(key)
+    if fragment is None:
+        metrics.cache_lookup('browse', 'miss')
+        fragment = _render(offer, offer_css, want, older, newer)
+        cache.set(key, fragment, timeout=app.config['BROWSE_CACHE_TIME'])
+    else:
+        metrics.cache_lookup('browse', 'hit')
+    return Markup(fragment)
@@ -0,0 +1,105 @@
+"""Pick the flair rules out of a subreddit stylesheet.
+
+This used to be done by building a cssutils object model of the whole sheet, which is very slow
+for a sheet the size of /r/mindcrack's. We only need to find top-level style rules and look at
+their selectors, so a tokenizer that knows about comments, strings, unquoted ``url()``s and nesting
+is enough.
+"""
+
+import re
+
+_token = re.compile(r'''
+    (?P<comment>/\*.*?(?:\*/|\Z))
+  | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)
+  | (?P<escape>\\.)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<semi>;)
+  | (?P<space>\s+)
+  | (?P<url>(?<=[uU][rR][lL])\((?!\s*["'])(?:[^)\\]|\\.)*\)?)
+  | (?P<other>[^{};"'/\\\s(]+|[/(])
+''', re.S | re.X)
+
+
+def _split_selectors(prelude):
+    """Split a selector list on the commas that aren't inside brackets or strings."""
+    selectors = []
+    depth = 0
+    quote = None
+    start = 0
+    i = 0
+    while i < len(prelude):
+        c = prelude[i]
+        if quote is not None:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c == '\\':
+            i += 1
+        elif c in '"\'':
+            quote = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            selectors.append(prelude[start:i].strip())
+            start = i + 1
+        i += 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def _emit(prelude, body, out):
+    selectors = _split_selectors(prelude)
+    matched = False
+    for n, selector in enumerate(selectors):
+        if selector == 'content':
+            selectors[n] = selector = '.flair'
+        if selector.startswith('.flair'):
+            matched = True
+    if matched:
+        out.append('{} {{{}}}'.format(', '.join(selectors), body.strip()))
+
+
+def flair_rules(text):
+    """Return the style rules in *text* that have a selector starting ``.flair``.
+
+    Only top-level rules count (nothing inside ``@media`` and so on), and the selector ``content``
+    is renamed to ``.flair`` first. Comments are dropped and whitespace is collapsed.
+    """
+    out = []
+    prelude = []
+    body = []
+    depth = 0
+    for m in _token.finditer(text):
+        kind = m.lastgroup
+        if kind in ('comment', 'space'):
+            current = prelude if depth == 0 else body
+            if current and current[-1] != ' ':
+                current.append(' ')
+        elif depth == 0:
+            if kind == 'open':
+                depth = 1
+                body = []
+            elif kind in ('semi', 'close'):
+                # the end of an @import or similar, or junk
+                prelude = []
+            else:
+                prelude.append(m.group())
+        elif kind == 'open':
+            depth += 1
+            body.append('{')
+        elif kind == 'close':
+            depth -= 1
+            if depth == 0:
+                selectors = ''.join(prelude).strip()
+                if selectors and not selectors.startswith('@'):
+                    _emit(selectors, ''.join(body), out)
+                prelude = []
+            else:
+                body.append('}')
+        else:
+            body.append(m.group())
+    return '\n'.join(out)
@@ -0,0 +1,106 @@
+"""Check that the queries the app makes are using indexes.
+
+``python manage.py explain`` runs EXPLAIN (EXPLAIN QUERY PLAN on SQLite) on each query below against
+the configured database and flags full table scans and sorts that aren't satisfied by an index.
+It exits non-zero if anything was flagged, so it can be run after a migration or a change to a
+query.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .app import db
+
+
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _explain(element, compiler, **kw):
+    return 'EXPLAIN ' + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'sqlite')
+def _explain_sqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+# an OR across two indexes has to sort what it finds; that's only the invalid and deleted trades.
+# stats groups a month of trades, which it's fine to sort.
+SORT_OK = {'admin.trades-deleted', 'admin.trades-deleted (older)', 'utils.StatsCommand'}
+
+
+def queries():
+    """(where, query) for each query worth checking, with plausible parameters."""
+    from . import admin, matching, utils
+    from .models import FlairWrite, GiveawayLog, SwapCycle, SwapCycleMember, Trade
+
+    now = datetime.utcnow()
+    yield 'views.trade_new', Trade.query_valid_by('someone').limit(1)
+    yield 'models.Trade.by_id', Trade.query.filter(Trade.id == '0' * 32, Trade.status != 'invalid',
+                                                   Trade.deleted == False).limit(1)
+    for search in ({}, {'offer': 'Team Shreeyam'}, {'offer_css': 'special1'}, {'want': 'Team Shreeyam'}):
+        query = Trade.query_open(**search)
+        yield 'browse.results {}'.format(sorted(search)), utils.keyset_query(query, Trade.created, Trade.id).limit(51)
+    yield 'matching.find_pair', (Trade.query_open(offer='Team Shreeyam', want='Team Shreeyam')
+                                 .filter(Trade.creator != 'someone').order_by(Trade.created, Trade.id).limit(1))
+    yield 'matching.find_cycles', matching.query_open_columns()
+    # EXPLAIN's rows come back typed like the query's columns, so stick to ones that aren't dates
+    yield 'matching.cycles_for', (SwapCycle.query.with_entities(SwapCycle.id).join(SwapCycleMember)
+                                  .filter(SwapCycleMember.trade_id == '0' * 32, SwapCycle.status == 'proposed'))
+    yield 'models.Trade.flair_state', FlairWrite.query.filter(FlairWrite.trade_id == '0' * 32,
+                                                              FlairWrite.applied == None)
+    for view in admin.admin._views:
+        if isinstance(view, admin.ListView):
+            query = Trade.query.filter(view.filter)
+            yield 'admin.' + view.endpoint, utils.keyset_query(query, view.order, Trade.id).limit(51)
+            older = utils.keyset_query(query, view.order, Trade.id, older='20150101000000000000~' + '0' * 32)
+            yield 'admin.' + view.endpoint + ' (older)', older.limit(51)
+    yield 'admin.giveaway-db', GiveawayLog.query.join(Trade).filter(Trade.creator == 'someone').limit(20)
+    yield 'utils.StatsCommand', utils.trade_activity_query(now - timedelta(days=30))
+    yield 'flairqueue._flush', FlairWrite.query_pending(now).limit(500)
+    yield 'flairqueue._flush (by user)', FlairWrite.query_unapplied(['someone'])
+    yield 'flairqueue._call_off_cycle', FlairWrite.query.filter(FlairWrite.cycle_id == 0,
+                                                                FlairWrite.applied != None)
+
+
+def _sqlite_problems(rows, sort_ok):
+    for row in rows:
+        detail = row[-1]
+        if detail.startswith('SCAN') and 'INDEX' not in detail:
+            yield detail
+        elif 'TEMP B-TREE' in detail and not sort_ok:
+            yield detail
+
+
+def _mysql_problems(rows, sort_ok):
+    for row in rows:
+        row = dict(row.items())
+        if row.get('type') == 'ALL':
+            yield 'full scan of {}'.format(row.get('table'))
+        if 'filesort' in (row.get('Extra') or '') and not sort_ok:
+            yield 'filesort on {}'.format(row.get('table'))
+
+
+def check(verbose=False):
+    """Explain every query, printing what's wrong. Returns the number of queries flagged."""
+    problems = _sqlite_problems if db.engine.dialect.name == 'sqlite' else _mysql_problems
+    flagged = 0
+    for where, query in queries():
+        rows = db.session.execute(Explain(query.statement)).fetchall()
+        found = list(problems(rows, where in SORT_OK))
+        if found:
+            flagged += 1
+        if found or verbose:
+            print('{} {}'.format('!!' if found else 'ok', where))
+            for problem in found:
+                print('    ' + problem)
+            if verbose:
+                for row in rows:
+                    print('    | ' + ' '.join(str(v) for v in row))
+    db.session.rollback()
+    return flagged
@@ -0,0 +1,221 @@
+"""Write-behind queue for flair changes.
+
+Views record the flair changes they want as FlairWrite rows, in the same transaction as the trade
+that needs them, and return straight away. The flair_writes job sends everything pending to reddit
+in set_flair_csv calls of up to 100 rows, retrying with backoff when reddit is unhappy.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from . import ratelimit, reddit, shared, tasks
+from .app import app, db
+from .models import FlairWrite, GiveawayLog, SwapCycle, SwapCycleMember, Trade
+
+logger = app.logger.getChild('flairqueue')
+
+BATCH_SIZE = 100  # the most set_flair_csv takes in one request
+
+
+def enqueue(rows, trade=None, giveaway_log=None, cycle_id=None):
+    """Queue flair changes, given as dicts like set_flair_csv takes. Commit, then kick()."""
+    for row in rows:
+        db.session.add(FlairWrite(row['user'], row['flair_text'], row['flair_css_class'],
+                                  trade=trade, giveaway_log=giveaway_log, cycle_id=cycle_id))
+
+
+def kick():
+    tasks.kick('flair_writes')
+
+
+@tasks.job(app.config['FLAIR_QUEUE_INTERVAL'])
+def flair_writes():
+    lock = shared.Lock('flair_writes', timeout=300)
+    if not lock.acquire():
+        return
+    try:
+        # someone is waiting to see their new flair, so these go ahead of other background work
+        with ratelimit.priority('interactive'):
+            while _flush():
+                pass
+    finally:
+        lock.release()
+        db.session.remove()
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(5 * 2 ** attempts, 600))
+
+
+def _flush():
+    """Send one batch. Returns True if it's worth going straight on to the next."""
+    now = datetime.utcnow()
+    pending = FlairWrite.query_pending(now).limit(BATCH_SIZE * 5).all()
+    if not pending:
+        return False
+
+    # only the newest write for each user matters; older ones ride along with it. that goes for
+    # their writes that aren't due yet, or didn't fit in pending, too: an older one mustn't be sent
+    # after (or instead of) something newer
+    latest = OrderedDict()
+    riders = {}
+    for write in FlairWrite.query_unapplied(list({w.user.lower() for w in pending})):
+        name = write.user.lower()
+        if name in latest:
+            riders.setdefault(name, []).append(latest[name])
+        latest[name] = write
+    for name, write in list(latest.items()):
+        if write.next_attempt is not None and write.next_attempt > now:
+            # the newest is itself waiting for a retry, so the older ones wait with it
+            for w in riders.pop(name, []):
+                w.next_attempt = write.next_attempt
+            del latest[name]
+    if not latest:
+        db.session.commit()
+        return len(pending) == BATCH_SIZE * 5
+    batch = list(latest.values())[:BATCH_SIZE]
+
+    try:
+        results = reddit.get(moderator=True).set_flair_csv(
+            app.config['REDDIT_SUBREDDIT'], [w.as_csv_row() for w in batch])
+    except Exception as e:
+        logger.warning('set_flair_csv failed for %d rows: %r', len(batch), e)
+        shared.incr('flair_queue', 'error')
+        given_up = []
+        for write in batch:
+            done = riders.get(write.user.lower(), [])
+            if _retry(write, now, repr(e)):
+                for w in done:
+                    w.failed = True
+                    w.error = write.error
+                given_up.extend([write] + done)
+            else:
+                for w in done:
+                    w.next_attempt = write.next_attempt
+        _resync(list({w.user for w in given_up}))
+        db.session.flush()
+        _compensate(given_up)
+        db.session.commit()
+        return False
+    shared.incr('flair_queue', 'call')
+
+    touched = set()
+    failed = []
+    rejected = []
+    for write, result in zip(batch, results):
+        done = [write] + riders.get(write.user.lower(), [])
+        if result.get('ok'):
+            shared.incr('flair_queue', 'applied', len(done))
+            for w in done:
+                w.applied = now
+                touched.add(w)
+        else:
+            # reddit looked at this row and said no; asking again won't change its mind
+            logger.error('set_flair_csv rejected %r: %r', write.as_csv_row(), result)
+            shared.incr('flair_queue', 'rejected')
+            for w in done:
+                w.failed = True
+                w.error = str(result.get('errors'))[:256]
+            failed.extend(done)
+            rejected.append(write.user)
+    _resync(rejected)
+    db.session.flush()
+    _mark_applied(touched, now)
+    _compensate(failed)
+    db.session.commit()
+    return len(latest) > len(batch) or len(pending) == BATCH_SIZE * 5
+
+
+def _retry(write, now, error):
+    """Schedule another attempt, or give up. Returns True if we gave up (and the caller should
+    _resync the user)."""
+    write.attempts += 1
+    write.error = error[:256]
+    if write.attempts >= app.config['FLAIR_QUEUE_MAX_ATTEMPTS']:
+        logger.error('giving up on flair write %d for /u/%s', write.id, write.user)
+        shared.incr('flair_queue', 'gave_up')
+        write.failed = True
+        return True
+    write.next_attempt = now + _backoff(write.attempts)
+    return False
+
+
+def _resync(users):
+    # the view optimistically cached the flair we were going to set; put the real one back
+    if not users:
+        return
+    try:
+        reddit.get_flairs(users, no_cache=True)
+    except Exception:
+        logger.exception("couldn't refresh flair for %s", ', '.join('/u/' + u for u in users))
+
+
+def _mark_applied(writes, now):
+    trade_ids = {w.trade_id for w in writes if w.trade_id is not None}
+    for trade_id in trade_ids:
+        outstanding = (FlairWrite.query
+                       .filter(FlairWrite.trade_id == trade_id, FlairWrite.applied == None)
+                       .count())
+        if outstanding == 0:
+            Trade.query.filter(Trade.id == trade_id).update({'flair_applied': now},
+                                                              synchronize_session=False)
+    log_ids = {w.giveaway_log_id for w in writes if w.giveaway_log_id is not None}
+    if log_ids:
+        GiveawayLog.query.filter(GiveawayLog.id.in_(log_ids)).update({'flair_applied': now},
+                                                                     synchronize_session=False)
+
+
+def _compensate(writes):
+    """Undo trades whose flair changes reddit wouldn't take."""
+    for cycle_id in {w.cycle_id for w in writes if w.cycle_id is not None}:
+        _call_off_cycle(cycle_id)
+    for trade in {w.trade for w in writes if w.trade is not None and w.cycle_id is None}:
+        if trade.status == 'finished' and trade.giveaway_count is None:
+            # put back whichever half of the swap did make it, and call the trade off
+            restore = {trade.creator.lower(): {'user': trade.creator,
+                                               'flair_text': trade.creator_flair,
+                                               'flair_css_class': trade.creator_flair_css},
+                       trade.target.lower(): {'user': trade.target,
+                                              'flair_text': trade.target_flair,
+                                              'flair_css_class': trade.target_flair_css}}
+            applied = FlairWrite.query.filter(FlairWrite.trade_id == trade.id, FlairWrite.applied != None).all()
+            enqueue([restore[w.user.lower()] for w in applied if w.user.lower() in restore])
+            trade.status = 'invalid'
+            logger.error('called off trade %s after a failed flair write', trade.id)
+        elif trade.giveaway_count is not None and trade.status in ('giveaway', 'finished'):
+            # hand the unclaimed copy back to the giveaway, and forget the claim, so the log doesn't
+            # show it and the user can try again
+            returned = [w for w in writes if w.trade is trade and w.giveaway_log_id is not None]
+            log_ids = [w.giveaway_log_id for w in returned]
+            for w in returned:
+                w.giveaway_log = None
+            db.session.flush()
+            GiveawayLog.query.filter(GiveawayLog.id.in_(log_ids)).delete(synchronize_session=False)
+            Trade.query.filter(Trade.id == trade.id).update(
+                {'giveaway_count': Trade.giveaway_count + len(returned), 'status': 'giveaway',
+                 'finalized': None},
+                synchronize_session=False)
+
+
+def _call_off_cycle(cycle_id):
+    """Undo all of a swap cycle when any of its writes fails: each trade only carries its own
+    creator's new flair, so the others would otherwise be left with flair nobody gave up."""
+    if not SwapCycle.call_off(cycle_id):
+        return
+    trades = (Trade.query
+              .join(SwapCycleMember, SwapCycleMember.trade_id == Trade.id)
+              .filter(SwapCycleMember.cycle_id == cycle_id)
+              .all())
+    restore = {trade.creator.lower(): {'user': trade.creator,
+                                       'flair_text': trade.creator_flair,
+                                       'flair_css_class': trade.creator_flair_css}
+               for trade in trades}
+    # whatever hasn't been sent yet needn't be, and whatever has goes back
+    FlairWrite.query.filter(FlairWrite.cycle_id == cycle_id, FlairWrite.applied == None,
+                            FlairWrite.failed == False).update(
+        {'failed': True, 'error': 'swap cycle called off'}, synchronize_session=False)
+    applied = FlairWrite.query.filter(FlairWrite.cycle_id == cycle_id, FlairWrite.applied != None).all()
+    enqueue([restore[w.user.lower()] for w in applied if w.user.lower() in restore])
+    Trade.query.filter(Trade.id.in_([trade.id for trade in trades])).update(
+        {'status': 'invalid'}, synchronize_session=False)
+    logger.error('called off swap cycle %s after a failed flair write', cycle_id)
@@ -0,0 +1,137 @@
+"""An in-process tier in front of Flask-Cache, for things that hardly ever change.
+
+The moderator list, our own account details and the stylesheet are read on most page renders but
+change perhaps once a month. Each worker keeps its own copy of these for up to
+``LOCAL_CACHE_TIME`` seconds. Whenever one of them is set or deleted, a message on a redis pub/sub
+channel tells every other worker to drop its copy.
+
+If a worker isn't subscribed (it's just started, or lost its connection to redis) it doesn't use its
+copies at all, as it may have missed an invalidation.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+
+import binascii
+import os
+import threading
+import time
+
+from . import metrics, shared
+from .app import app, cache
+
+logger = app.logger.getChild('localcache')
+
+CHANNEL = shared.key('invalidate')
+MAX_ENTRIES = 256
+
+_state = {'pid': None}
+
+
+def _local():
+    """This process's entries, starting the subscriber first if this is a new process (uWSGI forks
+    workers after importing the app, and threads don't survive that)."""
+    if _state['pid'] != os.getpid():
+        _state.update(pid=os.getpid(),
+                      id=binascii.hexlify(os.urandom(8)).decode('ascii'),
+                      entries=OrderedDict(),
+                      lock=threading.Lock(),
+                      generation=0,
+                      subscribed=False)
+        t = threading.Thread(target=_subscriber)
+        t.daemon = True
+        t.start()
+    return _state
+
+
+def _subscriber():
+    state = _state
+    while True:
+        try:
+            p = shared.store.pubsub()
+            p.subscribe(CHANNEL)
+            for msg in p.listen():
+                if msg['type'] == 'subscribe':
+                    # anything we had may have changed while we weren't listening
+                    with state['lock']:
+                        state['entries'].clear()
+                    state['subscribed'] = True
+                elif msg['type'] == 'message':
+                    origin, key = msg['data'].decode('utf8').split(' ', 1)
+                    if origin != state['id']:
+                        with state['lock']:
+                            state['entries'].pop(key, None)
+                            state['generation'] += 1
+        except Exception:
+            logger.exception('lost the invalidation channel')
+        state['subscribed'] = False
+        time.sleep(1)
+
+
+def _remember(state, key, value, timeout, generation=None):
+    lifetime = min(timeout or app.config['LOCAL_CACHE_TIME'], app.config['LOCAL_CACHE_TIME'])
+    with state['lock']:
+        if generation is not None and generation != state['generation']:
+            # something was invalidated while we were reading; it might have been this
+            return
+        state['entries'].pop(key, None)
+        state['entries'][key] = (time.time() + lifetime, value)
+        while len(state['entries']) > MAX_ENTRIES:
+            state['entries'].popitem(last=False)
+
+
+def _publish(state, key):
+    try:
+        shared.store.publish(CHANNEL, '{} {}'.format(state['id'], key))
+    except Exception:
+        logger.exception("couldn't publish invalidation for %s", key)
+
+
+def get(key, timeout=None):
+    """Return the value for *key*, from this worker if possible, otherwise from Flask-Cache."""
+    state = _local()
+    generation = state['generation']
+    if state['subscribed']:
+        with state['lock']:
+            entry = state['entries'].pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                state['entries'][key] = entry  # most recently used goes to the end
+                metrics.cache_lookup(key, 'local')
+                return entry[1]
+    value = cache.get(key)
+    metrics.cache_lookup(key, 'miss' if value is None else 'hit')
+    if value is not None and state['subscribed']:
+        _remember(state, key, value, timeout, generation)
+    return value
+
+
+def set(key, value, timeout=None):
+    state = _local()
+    cache.set(key, value, timeout=timeout)
+    _publish(state, key)
+    if state['subscribed']:
+        _remember(state, key, value, timeout)
+
+
+def delete(key):
+    state = _local()
+    with state['lock']:
+        state['entries'].pop(key, None)
+    cache.delete(key)
+    _publish(state, key)
+
+
+def cached(key, timeout):
+    """Like Flask-Cache's ``cached`` decorator, for functions without arguments."""
+    def wrap(fn):
+        @wraps(fn)
+        def wrapped():
+            value = get(key, timeout)
+            if value is None:
+                value = fn()
+                set(key, value, timeout)
+            return value
+        wrapped.uncached = fn
+        wrapped.cache_key = key
+        return wrapped
+    return wrap
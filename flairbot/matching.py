@@ -0,0 +1,254 @@
+"""Matching open trades with each other.
+
+Think of each open trade as an edge in a graph of flair texts, from the flair its creator has to the
+flair they want. Two trades pointing opposite ways between the same two flairs are a *pair*: either
+creator can simply accept the other's trade. ``find_pair`` looks for one with a single indexed query,
+so the trade page can suggest it the moment a trade is made.
+
+Longer cycles (A has what B wants, B has what C wants, C has what A wants) can't be done with
+ordinary accepts. The ``find_cycles`` job looks for them every ``MATCH_INTERVAL`` seconds, up to
+``MATCH_CYCLE_LENGTH`` trades long, and records each one it finds as a ``SwapCycle``. Every
+creator in it is asked on their trade page to agree, within ``MATCH_PROPOSAL_TTL`` seconds (after
+that its trades are free to be matched again), and once they all have, ``complete`` finishes
+all the trades at once. Their flair writes are tagged with the cycle, so if reddit turns any of them
+down the flair queue calls off the whole cycle and puts back everyone's flair.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+
+from . import browse, flairqueue, reddit, shared, tasks
+from .app import app, db
+from .models import SwapCycle, SwapCycleMember, Trade
+
+logger = app.logger.getChild('matching')
+
+# building and compiling the query takes ten times as long as running it, so do that once
+_bakery = baked.bakery()
+
+
+def find_pair(trade):
+    """The oldest open trade offering what *trade* wants for what it offers, or None."""
+    if trade.target is not None or not trade.target_flair:
+        return None
+    query = _bakery(lambda s: s.query(Trade))
+    query += lambda q: q.filter(Trade.status == 'valid', Trade.deleted == False, Trade.target == None,
+                                Trade.creator_flair == bindparam('offer'),
+                                Trade.target_flair == bindparam('want'),
+                                Trade.creator != bindparam('creator'))
+    query += lambda q: q.order_by(Trade.created, Trade.id).limit(1)
+    found = query(db.session()).params(offer=trade.target_flair, want=trade.creator_flair,
+                                       creator=trade.creator).all()
+    return found[0] if found else None
+
+
+class MatchIndex(object):
+    """Open trades, by the flair they offer and then the flair they want, oldest first."""
+
+    def __init__(self):
+        self.edges = {}  # offer -> {want -> OrderedDict(trade id -> creator)}
+        self.into = {}   # want -> {offer: number of trades}
+        self.trades = {}  # trade id -> (offer, want)
+
+    def __len__(self):
+        return len(self.trades)
+
+    def add(self, trade_id, creator, offer, want):
+        self.edges.setdefault(offer, {}).setdefault(want, OrderedDict())[trade_id] = creator
+        into = self.into.setdefault(want, {})
+        into[offer] = into.get(offer, 0) + 1
+        self.trades[trade_id] = (offer, want)
+
+    def remove(self, trade_id):
+        offer, want = self.trades.pop(trade_id)
+        wants = self.edges[offer]
+        del wants[want][trade_id]
+        if not wants[want]:
+            del wants[want]
+            if not wants:
+                del self.edges[offer]
+        into = self.into[want]
+        into[offer] -= 1
+        if not into[offer]:
+            del into[offer]
+            if not into:
+                del self.into[want]
+
+    def _distances_to(self, start, max_length):
+        """How many trades it takes to get from each flair to *start*, for flairs after *start*
+        that can get there in fewer than *max_length*."""
+        distances = {start: 0}
+        frontier = [start]
+        for distance in range(1, max_length):
+            reached = []
+            for node in frontier:
+                for offer in self.into.get(node, ()):
+                    if offer > start and offer not in distances:
+                        distances[offer] = distance
+                        reached.append(offer)
+            frontier = reached
+        return distances
+
+    def _find(self, start, min_length, max_length, distances):
+        """A cycle of flairs from *start* through flairs after it, as a list, or None."""
+        def extend(path):
+            for node in self.edges.get(path[-1], ()):
+                if node == start:
+                    if len(path) >= min_length:
+                        return path
+                elif (node > start and node not in path and
+                        len(path) + distances.get(node, max_length) <= max_length):
+                    found = extend(path + [node])
+                    if found:
+                        return found
+            return None
+        return extend([start])
+
+    def cycles(self, min_length=3, max_length=4):
+        """Take cycles of trades out of the index, oldest trades first, until there are none left.
+        Returns them as lists of trade ids, each trade wanting the flair the next one offers.
+
+        Each cycle is found from its smallest flair, and only passes through flairs after that, so
+        once a flair's cycles are used up it needn't be looked at again.
+        """
+        found = []
+        for start in sorted(self.edges):
+            distances = self._distances_to(start, max_length)
+            while start in self.edges:
+                path = self._find(start, min_length, max_length, distances)
+                if path is None:
+                    break
+                ids = [next(iter(self.edges[offer][want]))
+                       for offer, want in zip(path, path[1:] + path[:1])]
+                for trade_id in ids:
+                    self.remove(trade_id)
+                found.append(ids)
+        return found
+
+
+def query_open_columns():
+    """(id, creator, offer, want) for every open trade that wants a flair, oldest first."""
+    return (Trade.query_open()
+            .filter(Trade.target_flair != None)
+            .with_entities(Trade.id, Trade.creator, Trade.creator_flair, Trade.target_flair)
+            .order_by(Trade.created, Trade.id))
+
+
+@tasks.job(app.config['MATCH_INTERVAL'])
+def find_cycles():
+    lock = shared.Lock('find_cycles', timeout=600)
+    if not lock.acquire():
+        return
+    try:
+        busy = set()
+        expired = datetime.utcnow() - timedelta(seconds=app.config['MATCH_PROPOSAL_TTL'])
+        for cycle in SwapCycle.query.filter(SwapCycle.status == 'proposed'):
+            # someone who never answers mustn't keep the others' trades out of every other cycle
+            if cycle.is_open and cycle.created > expired:
+                busy.update(m.trade_id for m in cycle.members)
+            else:
+                SwapCycle.cancel(cycle.id)
+        index = MatchIndex()
+        for trade_id, creator, offer, want in query_open_columns():
+            if trade_id not in busy:
+                index.add(trade_id, creator, offer, want)
+        cycles = index.cycles(3, app.config['MATCH_CYCLE_LENGTH'])
+        for trades in cycles:
+            db.session.add(SwapCycle(trades))
+        db.session.commit()
+        if cycles:
+            logger.info('proposed %d swap cycles', len(cycles))
+    finally:
+        lock.release()
+        db.session.remove()
+
+
+def cycles_for(trade):
+    """The swap cycles *trade* is in that could still go ahead."""
+    cycles = (SwapCycle.query
+              .join(SwapCycleMember)
+              .filter(SwapCycleMember.trade_id == trade.id, SwapCycle.status == 'proposed')
+              .all())
+    return [c for c in cycles if c.is_open]
+
+
+def agree(cycle_id, trade):
+    """Record that *trade*'s creator agrees to the cycle, and complete it if they were the last to.
+
+    Returns None if *trade* isn't in a proposed cycle *cycle_id*; otherwise 'agreed', 'finished' or
+    'cancelled'.
+    """
+    member = (SwapCycleMember.query
+              .join(SwapCycle)
+              .filter(SwapCycleMember.cycle_id == cycle_id, SwapCycleMember.trade_id == trade.id,
+                      SwapCycle.status == 'proposed')
+              .first())
+    if member is None:
+        return None
+    if member.agreed is None:
+        member.agreed = datetime.utcnow()
+        db.session.commit()
+    cycle = member.cycle
+    if any(m.agreed is None for m in cycle.members):
+        return 'agreed'
+    return complete(cycle)
+
+
+def complete(cycle):
+    """Finish every trade in *cycle*, giving each creator the flair offered by the next trade.
+
+    Like ``trade_accept`` this holds no locks: everyone's flair is checked with reddit first, then
+    the cycle and each of its trades are claimed with conditional UPDATEs in one transaction, so if
+    any of them has been taken in the meantime none of it happens. Returns 'finished' (whether
+    it was this call that finished it or another) or 'cancelled'.
+    """
+    trades = [m.trade for m in cycle.members]
+    cycle_id = cycle.id
+    for trade in trades:
+        db.session.expunge(trade)
+    db.session.rollback()
+
+    found = reddit.get_flairs([trade.creator for trade in trades], no_cache=True)
+    flairs = [found[trade.creator] for trade in trades]
+    try:
+        for trade, flair in zip(trades, flairs):
+            if (flair is None or flair['flair_text'] != trade.creator_flair or
+                    flair['flair_css_class'] != trade.creator_flair_css):
+                Trade.invalidate(trade.id)
+                SwapCycle.cancel(cycle_id)
+                db.session.commit()
+                browse.changed()
+                return 'cancelled'
+
+        if not SwapCycle.claim(cycle_id):
+            db.session.rollback()
+            return 'finished' if SwapCycle.query.get(cycle_id).status == 'finished' else 'cancelled'
+        changes = []
+        for i, trade in enumerate(trades):
+            giver, flair = trades[(i + 1) % len(trades)], flairs[(i + 1) % len(trades)]
+            if not Trade.claim(trade.id,
+                               target=giver.creator,
+                               target_flair=flair['flair_text'],
+                               target_flair_css=flair['flair_css_class']):
+                db.session.rollback()
+                SwapCycle.cancel(cycle_id)
+                db.session.commit()
+                return 'cancelled'
+            change = {'user': trade.creator,
+                      'flair_text': flair['flair_text'],
+                      'flair_css_class': flair['flair_css_class']}
+            flairqueue.enqueue([change], trade=trade, cycle_id=cycle_id)
+            changes.append(change)
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+
+    browse.changed()
+    flairqueue.kick()
+    for change in changes:
+        reddit.update_flair_cache(change['user'], change)
+    return 'finished'
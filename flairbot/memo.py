@@ -0,0 +1,75 @@
+"""Remember answers for the rest of the request.
+
+Templates and views ask the same questions (am I an admin? what's this user's flair?) several times
+per request. Each answer comes from redis or reddit, so it's worth asking only once.
+
+With ``BACKEND_CALLS_HEADER`` set, responses carry an ``X-Backend-Calls`` header counting the
+questions that weren't already answered.
+"""
+
+from functools import wraps
+
+from flask import g, has_request_context
+
+from .app import app
+
+
+def _memo():
+    if not hasattr(g, 'memo'):
+        g.memo = {}
+        g.backend_calls = {}
+    return g.memo
+
+
+def get(key, fn):
+    """The remembered answer for *key*, or ``fn()`` if there isn't one yet. *key* is a tuple
+    starting with the name of the question. Outside a request, always calls *fn*."""
+    if not has_request_context():
+        return fn()
+    memo = _memo()
+    if key not in memo:
+        memo[key] = fn()
+        g.backend_calls[key[0]] = g.backend_calls.get(key[0], 0) + 1
+    return memo[key]
+
+
+def get_many(name, args, fn):
+    """Like ``get`` for the keys ``(name, arg)`` for each of *args*, but ``fn`` is called once with
+    the args that haven't been answered yet, and returns ``{arg: answer}`` for them all."""
+    if not has_request_context():
+        return fn(list(args))
+    memo = _memo()
+    missing = [arg for arg in args if (name, arg) not in memo]
+    if missing:
+        answers = fn(missing)
+        for arg in missing:
+            memo[(name, arg)] = answers[arg]
+        g.backend_calls[name] = g.backend_calls.get(name, 0) + 1
+    return {arg: memo[(name, arg)] for arg in args}
+
+
+def put(key, value):
+    if has_request_context():
+        _memo()[key] = value
+
+
+def forget(key):
+    if has_request_context():
+        _memo().pop(key, None)
+
+
+def per_request(fn):
+    """Remember what *fn* returns for each set of arguments until the end of the request."""
+    @wraps(fn)
+    def wrapped(*args):
+        return get((fn.__name__,) + args, lambda: fn(*args))
+    return wrapped
+
+
+@app.after_request
+def backend_calls_header(response):
+    if app.config.get('BACKEND_CALLS_HEADER'):
+        calls = getattr(g, 'backend_calls', {})
+        response.headers['X-Backend-Calls'] = ', '.join(
+            '{}={}'.format(name, n) for name, n in sorted(calls.items())) or 'none'
+    return response
@@ -0,0 +1,242 @@
+"""Prometheus metrics, added up across every worker.
+
+Each worker adds its observations to hashes in redis, one per metric, and ``/metrics`` reads them
+back in Prometheus' text format. Observations made while handling a request are saved up and sent
+in one go when the request is over; anything else is sent straight away.
+
+``/metrics`` is for admins, or for anyone who sends ``METRICS_TOKEN`` as a bearer token (so a
+Prometheus server can scrape it without logging in to reddit).
+"""
+
+from flask import abort, g, has_request_context, request
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import hmac
+import re
+import time
+
+from . import shared
+from .app import app
+
+logger = app.logger.getChild('metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_registry = []
+
+
+def _label_string(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('{}="{}"'.format(n, escape(v)) for n, v in zip(names, values))
+
+
+def _format_number(n):
+    return '{:.0f}'.format(n) if n == int(n) else repr(float(n))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.key = shared.key('metrics', name)
+        _registry.append(self)
+
+    def commands(self, *values, **kw):
+        return [('hincrbyfloat', self.key, _label_string(self.labels, values), kw.get('amount', 1))]
+
+    def inc(self, *values, **kw):
+        _send(self.commands(*values, **kw))
+
+    def render(self, fields):
+        for labels, value in sorted(fields.items()):
+            yield '{}{{{}}} {}'.format(self.name, labels, _format_number(float(value)))
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.key = shared.key('metrics', name)
+        _registry.append(self)
+
+    def commands(self, value, *values):
+        labels = _label_string(self.labels, values)
+        bucket = next((b for b in self.buckets if value <= b), '+Inf')
+        return [('hincrby', self.key, '{}|{}'.format(labels, bucket), 1),
+                ('hincrbyfloat', self.key, labels + '|sum', value)]
+
+    def observe(self, value, *values):
+        _send(self.commands(value, *values))
+
+    def render(self, fields):
+        series = {}
+        for field, value in fields.items():
+            labels, part = field.rsplit('|', 1)
+            series.setdefault(labels, {})[part] = float(value)
+        for labels, parts in sorted(series.items()):
+            sep = ',' if labels else ''
+            total = 0
+            for bucket in self.buckets + ('+Inf',):
+                total += parts.get(str(bucket), 0)
+                yield '{}_bucket{{{}{}le="{}"}} {}'.format(self.name, labels, sep, bucket,
+                                                            _format_number(total))
+            yield '{}_sum{{{}}} {}'.format(self.name, labels, _format_number(parts.get('sum', 0)))
+            yield '{}_count{{{}}} {}'.format(self.name, labels, _format_number(total))
+
+
+request_seconds = Histogram(
+    'flairbot_request_seconds', 'Time taken to handle a request.', ('endpoint', 'status'))
+request_queries = Histogram(
+    'flairbot_request_db_queries', 'Database queries made while handling a request.', ('endpoint',),
+    buckets=QUERY_BUCKETS)
+request_query_seconds = Histogram(
+    'flairbot_request_db_seconds', 'Time spent in the database while handling a request.', ('endpoint',))
+lock_wait_seconds = Histogram(
+    'flairbot_db_lock_seconds', 'Time taken by SELECT ... FOR UPDATE queries, most of which is '
+    'waiting for the rows to be unlocked.', ('table',))
+reddit_seconds = Histogram(
+    'flairbot_reddit_request_seconds', 'Time taken by requests to reddit.', ('method', 'path'))
+reddit_requests = Counter(
+    'flairbot_reddit_requests_total', 'Requests made to reddit, by response status.',
+    ('method', 'path', 'status'))
+cache_lookups = Counter(
+    'flairbot_cache_lookups_total', 'Cache lookups, by what answered them: local (this worker), '
+    'hit (redis), mirror (the flair mirror), negative (remembered as missing) or miss.', ('function', 'result'))
+
+
+def _send(commands):
+    if has_request_context():
+        g.setdefault('metrics_pending', []).extend(commands)
+    else:
+        _flush(commands)
+
+
+def _flush(commands):
+    """Metrics are informational, so a redis failure is ignored."""
+    if not commands:
+        return
+    try:
+        pipe = shared.store.pipeline(transaction=False)
+        for command, key, field, amount in commands:
+            getattr(pipe, command)(key, field, amount)
+        pipe.execute()
+    except Exception:
+        logger.exception("couldn't record metrics")
+
+
+# reddit paths, with names and ids taken out so there's a manageable number of them
+_reddit_paths = [
+    (re.compile(r'^/r/[^/]+'), '/r/{subreddit}'),
+    (re.compile(r'^/(user|u)/[^/]+'), '/user/{name}'),
+    (re.compile(r'/comments/[^/]+(/[^/]*)?(/[^/]+)?'), '/comments/{id}'),
+    (re.compile(r'\.json$'), ''),
+    (re.compile(r'/$'), ''),
+]
+
+
+def reddit_path(url):
+    path = re.sub(r'^[a-z]+://[^/]+', '', url).split('?', 1)[0]
+    for pattern, replacement in _reddit_paths:
+        path = pattern.sub(replacement, path)
+    return path or '/'
+
+
+def observe_reddit(method, url, status, seconds):
+    path = reddit_path(url)
+    reddit_seconds.observe(seconds, method, path)
+    reddit_requests.inc(method, path, status)
+
+
+def cache_lookup(function, result, n=1):
+    cache_lookups.inc(function, result, amount=n)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+_for_update_table = re.compile(r'\bFROM\s+[`"]?(\w+)', re.IGNORECASE)
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = time.time() - started.pop()
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_queries += 1
+        g.metrics_query_seconds += elapsed
+    if statement.rstrip().upper().endswith('FOR UPDATE'):
+        table = _for_update_table.search(statement)
+        lock_wait_seconds.observe(elapsed, table.group(1) if table else '')
+
+
+@app.before_request
+def _start_request():
+    g.metrics_started = time.time()
+    g.metrics_queries = 0
+    g.metrics_query_seconds = 0.0
+
+
+@app.after_request
+def _note_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _finish_request(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    endpoint = request.endpoint or 'none'
+    status = 500 if exc is not None else g.get('metrics_status', 500)
+    commands = g.pop('metrics_pending', [])
+    commands += request_seconds.commands(time.time() - started, endpoint, status)
+    commands += request_queries.commands(g.metrics_queries, endpoint)
+    commands += request_query_seconds.commands(g.metrics_query_seconds, endpoint)
+    _flush(commands)
+
+
+def _authorized():
+    token = app.config.get('METRICS_TOKEN')
+    if token:
+        given = request.headers.get('Authorization', '')
+        if given.startswith('Bearer ') and hmac.compare_digest(given[7:].encode('utf8'),
+                                                               token.encode('utf8')):
+            return True
+    from . import utils
+    return utils.is_admin()
+
+
+def render():
+    pipe = shared.store.pipeline(transaction=False)
+    for metric in _registry:
+        pipe.hgetall(metric.key)
+    lines = []
+    for metric, fields in zip(_registry, pipe.execute()):
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        fields = {k.decode('utf8'): v for k, v in fields.items()}
+        lines.extend(metric.render(fields))
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics():
+    if not _authorized():
+        abort(403)
+    return render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
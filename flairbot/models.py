@@ -1,6 +1,7 @@
 from flask import request, url_for
 from datetime import datetime
 from markupsafe import Markup
+from sqlalchemy import func, or_
 from sqlalchemy.types import TypeDecorator, String
 from sqlalchemy.orm import relationship
 
@@ -26,6 +27,25 @@ class AsciiString(TypeDecorator):
 
 
 class Trade(db.Model):
+    __table_args__ = (
+        # trade_new: the user's open trade
+        db.Index('ix_trade_creator', 'creator', 'status', 'deleted'),
+        # admin lists and stats, newest first; id breaks ties for keyset paging
+        db.Index('ix_trade_status_finalized', 'status', 'deleted', 'finalized', 'id'),
+        db.Index('ix_trade_status_created', 'status', 'deleted', 'created', 'id'),
+        db.Index('ix_trade_deleted_created', 'deleted', 'created', 'id'),
+        # browsing open trades by flair, newest first; MySQL can only index a prefix of the longer
+        # columns
+        db.Index('ix_trade_open_offer', 'status', 'deleted', 'creator_flair', 'created', 'id',
+                 mysql_length={'creator_flair': 191}),
+        db.Index('ix_trade_open_offer_css', 'status', 'deleted', 'creator_flair_css', 'created', 'id'),
+        db.Index('ix_trade_open_want', 'status', 'deleted', 'target_flair', 'created', 'id',
+                 mysql_length={'target_flair': 191}),
+        # matching: the oldest open trade offering one flair for another
+        db.Index('ix_trade_open_pair', 'status', 'deleted', 'creator_flair', 'target_flair', 'created', 'id',
+                 mysql_length={'creator_flair': 191, 'target_flair': 191}),
+    )
+
     id = db.Column(AsciiString(32), primary_key=True)
     status = db.Column(db.Enum('valid', 'invalid', 'finished', 'giveaway'), default='valid')
     deleted = db.Column(db.Boolean(), default=False)
@@ -46,6 +66,8 @@ class Trade(db.Model):
     creator_ip = db.Column(db.String(64))
     target_ip = db.Column(db.String(64))
 
+    flair_applied = db.Column(db.DateTime())
+
     def __init__(self,
                  creator=None, creator_flair=None, creator_flair_css=None,
                  target=None, target_flair=None, target_flair_css=None):
@@ -66,6 +88,17 @@ class Trade(db.Model):
         if status != 'valid':
             self.finalized = datetime.utcnow()
 
+    @property
+    def flair_state(self):
+        """'pending' while flair changes for this trade are queued, 'failed' if reddit wouldn't
+        take them, otherwise 'applied'."""
+        writes = FlairWrite.query.filter(FlairWrite.trade_id == self.id, FlairWrite.applied == None).all()
+        if not writes:
+            return 'applied'
+        if any(w.failed for w in writes):
+            return 'failed'
+        return 'pending'
+
     @property
     def render_creator(self):
         return utils.render_flair(self.creator_flair, self.creator_flair_css)
@@ -78,6 +111,23 @@ class Trade(db.Model):
     def query_valid(cls):
         return cls.query.filter(cls.status == 'valid', cls.deleted != True)
 
+    @classmethod
+    def query_valid_by(cls, creator):
+        return cls.query_valid().filter(cls.creator == creator)
+
+    @classmethod
+    def query_open(cls, offer=None, offer_css=None, want=None):
+        """Trades anyone can accept, optionally only those offering the flair *offer* (and/or the
+        css class *offer_css*) or wanting *want*. Each filter has an index to itself."""
+        query = cls.query.filter(cls.status == 'valid', cls.deleted == False, cls.target == None)
+        if offer:
+            query = query.filter(cls.creator_flair == offer)
+        if offer_css:
+            query = query.filter(cls.creator_flair_css == offer_css)
+        if want:
+            query = query.filter(cls.target_flair == want)
+        return query
+
     @classmethod
     def by_id(cls, id_, allow_invalid=False, allow_finished=False, allow_deleted=False, for_update=False):
         query = cls.query
@@ -95,6 +145,43 @@ class Trade(db.Model):
         else:
             return None
 
+    @classmethod
+    def claim(cls, id_, **values):
+        """Finish an open trade, setting *values* on it, in one conditional UPDATE.
+
+        Returns False if it wasn't open any more, because someone else got there first or it was
+        deleted. Commit afterwards.
+        """
+        values.update(status='finished', finalized=datetime.utcnow())
+        updated = (cls.query
+                   .filter(cls.id == id_, cls.status == 'valid', cls.deleted == False)
+                   .update(values, synchronize_session=False))
+        return updated == 1
+
+    @classmethod
+    def claim_giveaway(cls, id_):
+        """Take one copy from an open giveaway, in one conditional UPDATE.
+
+        Returns False if there are none left. Nothing is locked beyond the UPDATE itself, so commit
+        promptly; rolling back puts the copy back. Call it before writing anything that refers to
+        the trade, or two claims can deadlock.
+        """
+        updated = (cls.query
+                   .filter(cls.id == id_, cls.status == 'giveaway', cls.deleted == False,
+                           cls.giveaway_count > 0)
+                   .update({'giveaway_count': cls.giveaway_count - 1}, synchronize_session=False))
+        if updated != 1:
+            return False
+        (cls.query
+         .filter(cls.id == id_, cls.status == 'giveaway', cls.giveaway_count <= 0)
+         .update({'status': 'finished', 'finalized': datetime.utcnow()}, synchronize_session=False))
+        return True
+
+    @classmethod
+    def invalidate(cls, id_):
+        cls.query.filter(cls.id == id_, cls.status == 'valid').update(
+            {'status': 'invalid', 'finalized': datetime.utcnow()}, synchronize_session=False)
+
     def make_accept_token(self):
         self.accept_token = binascii.hexlify(os.urandom(16))
 
@@ -103,6 +190,9 @@ class Trade(db.Model):
 
 
 class GiveawayLog(db.Model):
+    # one claim per user per giveaway
+    __table_args__ = (db.Index('ix_giveaway_log_trade_target', 'trade_id', 'target', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
 
     trade_id = db.Column(AsciiString(32), db.ForeignKey('trade.id'))
@@ -114,6 +204,7 @@ class GiveawayLog(db.Model):
     target_ip = db.Column(db.String(64))
 
     time = db.Column(db.DateTime())
+    flair_applied = db.Column(db.DateTime())
 
     def __init__(self, trade, target, target_flair, target_flair_css, target_ip):
         self.trade = trade
@@ -122,3 +213,150 @@ class GiveawayLog(db.Model):
         self.target_flair_css = target_flair_css
         self.target_ip = target_ip
         self.time = datetime.utcnow()
+
+
+class FlairWrite(db.Model):
+    """A flair change waiting to be sent to reddit by the flair queue."""
+    __table_args__ = (db.Index('ix_flair_write_pending', 'applied', 'failed', 'id'),
+                      db.Index('ix_flair_write_trade', 'trade_id', 'applied'),
+                      db.Index('ix_flair_write_cycle', 'cycle_id', 'applied'))
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user = db.Column(db.String(32))
+    flair_text = db.Column(db.String(256))
+    flair_css_class = db.Column(db.String(64))
+
+    trade_id = db.Column(AsciiString(32), db.ForeignKey('trade.id'))
+    trade = relationship('Trade')
+    giveaway_log_id = db.Column(db.Integer, db.ForeignKey('giveaway_log.id'))
+    giveaway_log = relationship('GiveawayLog')
+    # set for the writes of a swap cycle, which stand or fall together
+    cycle_id = db.Column(db.Integer, db.ForeignKey('swap_cycle.id'))
+
+    created = db.Column(db.DateTime())
+    attempts = db.Column(db.Integer(), default=0)
+    next_attempt = db.Column(db.DateTime())
+    applied = db.Column(db.DateTime())
+    failed = db.Column(db.Boolean(), default=False)
+    error = db.Column(db.String(256))
+
+    def __init__(self, user, flair_text, flair_css_class, trade=None, giveaway_log=None, cycle_id=None):
+        self.user = user
+        self.flair_text = flair_text
+        self.flair_css_class = flair_css_class
+        self.trade = trade
+        self.giveaway_log = giveaway_log
+        self.cycle_id = cycle_id
+        self.created = datetime.utcnow()
+        self.attempts = 0
+        self.failed = False
+
+    @classmethod
+    def query_pending(cls, now):
+        return (cls.query
+                .filter(cls.applied == None, cls.failed == False,
+                        or_(cls.next_attempt == None, cls.next_attempt <= now))
+                .order_by(cls.id))
+
+    @classmethod
+    def query_unapplied(cls, names):
+        """Every write for any of *names* (lowercased) that's still to go, due or not."""
+        return (cls.query
+                .filter(cls.applied == None, cls.failed == False, func.lower(cls.user).in_(names))
+                .order_by(cls.id))
+
+    def as_csv_row(self):
+        return {'user': self.user,
+                'flair_text': self.flair_text or '',
+                'flair_css_class': self.flair_css_class or ''}
+
+
+class SwapCycle(db.Model):
+    """A ring of open trades, found by the matcher, in which each trade wants the flair the next one
+    offers. If every creator agrees, all the trades are completed together."""
+    __table_args__ = (db.Index('ix_swap_cycle_status', 'status'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.Enum('proposed', 'finished', 'cancelled'), default='proposed')
+    created = db.Column(db.DateTime())
+    finalized = db.Column(db.DateTime())
+
+    members = relationship('SwapCycleMember', order_by='SwapCycleMember.position')
+
+    def __init__(self, trades):
+        self.status = 'proposed'
+        self.created = datetime.utcnow()
+        self.members = [SwapCycleMember(trade_id, i) for i, trade_id in enumerate(trades)]
+
+    @property
+    def is_open(self):
+        """Whether the cycle can still go ahead: it's proposed and all its trades are open."""
+        return self.status == 'proposed' and all(
+            m.trade.status == 'valid' and not m.trade.deleted and m.trade.target is None
+            for m in self.members)
+
+    @classmethod
+    def claim(cls, id_):
+        """Mark a proposed cycle finished, in one conditional UPDATE. Returns False if it wasn't
+        proposed any more."""
+        updated = (cls.query
+                   .filter(cls.id == id_, cls.status == 'proposed')
+                   .update({'status': 'finished', 'finalized': datetime.utcnow()}, synchronize_session=False))
+        return updated == 1
+
+    @classmethod
+    def cancel(cls, id_):
+        cls.query.filter(cls.id == id_, cls.status == 'proposed').update(
+            {'status': 'cancelled', 'finalized': datetime.utcnow()}, synchronize_session=False)
+
+    @classmethod
+    def call_off(cls, id_):
+        """Cancel a finished cycle, after reddit turned down part of it. Returns False if it had
+        already been called off."""
+        updated = cls.query.filter(cls.id == id_, cls.status == 'finished').update(
+            {'status': 'cancelled', 'finalized': datetime.utcnow()}, synchronize_session=False)
+        return updated == 1
+
+
+class SwapCycleMember(db.Model):
+    __table_args__ = (db.Index('ix_swap_cycle_member_trade', 'trade_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    cycle_id = db.Column(db.Integer, db.ForeignKey('swap_cycle.id'))
+    cycle = relationship('SwapCycle')
+    position = db.Column(db.Integer())
+    trade_id = db.Column(AsciiString(32), db.ForeignKey('trade.id'))
+    trade = relationship('Trade')
+    agreed = db.Column(db.DateTime())
+
+    def __init__(self, trade_id, position):
+        self.trade_id = trade_id
+        self.position = position
+
+
+class StatsAuthor(db.Model):
+    """The flair someone had the last time the stats crawl saw them post."""
+    __table_args__ = (db.Index('ix_stats_author_last_seen', 'last_seen'),)
+
+    name = db.Column(db.String(32), primary_key=True)
+    flair_text = db.Column(db.String(256))
+    flair_css_class = db.Column(db.String(64))
+    last_seen = db.Column(db.DateTime())
+
+
+class StatsSubmission(db.Model):
+    """A submission in the stats window, and how much of its comment tree has been counted."""
+    __table_args__ = (db.Index('ix_stats_submission_created', 'created'),)
+
+    id = db.Column(db.String(16), primary_key=True)
+    created = db.Column(db.DateTime())
+    num_comments = db.Column(db.Integer())     # as of the last listing
+    counted_comments = db.Column(db.Integer())  # as of the last time all its comments were counted
+    counted = db.Column(db.DateTime())
+
+
+class StatsCursor(db.Model):
+    """Where the stats crawl got to in a listing."""
+    name = db.Column(db.String(32), primary_key=True)
+    position = db.Column(db.DateTime())
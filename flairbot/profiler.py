@@ -0,0 +1,188 @@
+"""Sample the stacks of live requests, to see where their time goes.
+
+An admin starts a profiling session from the admin pages. Until it ends, a percentage of requests
+(optionally only those to one endpoint) are profiled: a thread in each worker looks at their stacks
+every ``PROFILE_INTERVAL`` seconds. When a profiled request is over its samples are added to a
+hash in redis, so the admin pages can offer the stacks from every worker together, in the
+collapsed format ``flamegraph.pl`` reads.
+
+When no session is running, each worker checks for one at most once a second, and that's all.
+"""
+
+from collections import Counter
+from flask import g, request
+
+import os
+import random
+import sys
+import threading
+import time
+
+import redis
+
+from . import shared
+from .app import app
+
+logger = app.logger.getChild('profiler')
+
+_session_key = shared.key('profile', 'session')
+_stacks_key = shared.key('profile', 'stacks')
+_totals_key = shared.key('profile', 'totals')
+
+KEEP_RESULTS = 7 * 86400
+
+_state = {'pid': None}
+_short_names = {}
+
+
+def _local():
+    """This process's profiling state, starting the sampler if this is a new process."""
+    if _state['pid'] != os.getpid():
+        _state.update(pid=os.getpid(),
+                      lock=threading.Lock(),
+                      wake=threading.Event(),
+                      threads={},
+                      checked=0,
+                      session=None)
+        t = threading.Thread(target=_sampler)
+        t.daemon = True
+        t.start()
+    return _state
+
+
+def _short_name(filename):
+    """*filename* relative to whichever ``sys.path`` entry it's under, so frames read
+    ``praw/__init__.py`` rather than the whole path to site-packages."""
+    if filename not in _short_names:
+        short = filename
+        for path in sys.path:
+            if path and filename.startswith(path.rstrip(os.sep) + os.sep):
+                candidate = filename[len(path.rstrip(os.sep)) + 1:]
+                if len(candidate) < len(short):
+                    short = candidate
+        _short_names[filename] = short
+    return _short_names[filename]
+
+
+def _collapse(frame):
+    """The stack above *frame*, outermost first, as ``file:function;file:function;...``.
+    Frames outside Flask's request dispatch are left out, as they're the same every time."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == 'full_dispatch_request':
+            break
+        names.append('{}:{}'.format(_short_name(code.co_filename), code.co_name).replace(' ', '_'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _sampler():
+    state = _state
+    while True:
+        if not state['threads']:
+            state['wake'].wait(1)
+            state['wake'].clear()
+            continue
+        time.sleep(app.config['PROFILE_INTERVAL'])
+        frames = sys._current_frames()
+        with state['lock']:
+            for ident, samples in state['threads'].items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[_collapse(frame)] += 1
+
+
+def _current_session(state):
+    now = time.time()
+    if now - state['checked'] >= 1:
+        state['checked'] = now
+        try:
+            state['session'] = session()
+        except redis.RedisError:
+            state['session'] = None
+    s = state['session']
+    return s if s is not None and s['until'] > now else None
+
+
+def session():
+    """The running session, as a dict with ``until``, ``percent`` and ``endpoint``; or None."""
+    s = shared.store.hgetall(_session_key)
+    if not s:
+        return None
+    s = {k.decode('utf8'): v.decode('utf8') for k, v in s.items()}
+    return {'until': float(s['until']), 'percent': float(s['percent']),
+            'endpoint': s['endpoint'] or None}
+
+
+def start(percent, seconds, endpoint=None):
+    """Profile *percent* of requests (to *endpoint*, if given) for the next *seconds*."""
+    pipe = shared.store.pipeline()
+    pipe.delete(_session_key)
+    pipe.hmset(_session_key, {'until': time.time() + seconds, 'percent': percent,
+                              'endpoint': endpoint or ''})
+    pipe.expire(_session_key, int(seconds) + 1)
+    pipe.execute()
+
+
+def stop():
+    shared.store.delete(_session_key)
+
+
+def clear():
+    shared.store.delete(_stacks_key, _totals_key)
+
+
+def totals():
+    """How many requests have been profiled, and how many samples were taken of them."""
+    t = shared.store.hgetall(_totals_key)
+    return int(t.get(b'requests', 0)), int(t.get(b'samples', 0))
+
+
+def stacks():
+    """[(stack, samples)] for every stack seen, most common first. Each stack starts with the
+    endpoint."""
+    s = [(k.decode('utf8'), int(v)) for k, v in shared.store.hgetall(_stacks_key).items()]
+    return sorted(s, key=lambda x: (-x[1], x[0]))
+
+
+def collapsed():
+    return ''.join('{} {}\n'.format(stack, n) for stack, n in stacks())
+
+
+@app.before_request
+def _maybe_profile():
+    state = _local()
+    s = _current_session(state)
+    if s is None:
+        return
+    if s['endpoint'] is not None and s['endpoint'] != request.endpoint:
+        return
+    if random.random() * 100 >= s['percent']:
+        return
+    g.profile_samples = Counter()
+    with state['lock']:
+        state['threads'][threading.current_thread().ident] = g.profile_samples
+    state['wake'].set()
+
+
+@app.teardown_request
+def _finish_profile(exc):
+    samples = g.pop('profile_samples', None)
+    if samples is None:
+        return
+    state = _local()
+    with state['lock']:
+        state['threads'].pop(threading.current_thread().ident, None)
+    endpoint = request.endpoint or 'none'
+    try:
+        pipe = shared.store.pipeline(transaction=False)
+        for stack, n in samples.items():
+            pipe.hincrby(_stacks_key, ';'.join(filter(None, (endpoint, stack))), n)
+        pipe.hincrby(_totals_key, 'requests', 1)
+        pipe.hincrby(_totals_key, 'samples', sum(samples.values()))
+        pipe.expire(_stacks_key, KEEP_RESULTS)
+        pipe.expire(_totals_key, KEEP_RESULTS)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception("couldn't save profile samples")
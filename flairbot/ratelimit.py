@@ -0,0 +1,152 @@
+"""One reddit rate limit for every worker.
+
+praw only spaces out the requests made by a single process, and knows nothing about the others. So
+every request to reddit takes a token from a bucket kept in redis first, refilled at
+``REDDIT_RATE`` a second. The bucket also remembers what reddit's ``X-Ratelimit-Remaining`` and
+``X-Ratelimit-Reset`` headers last said, and stops handing out tokens when reddit says we've run
+out.
+
+Requests made on behalf of someone clicking a button come first. Background jobs and
+``manage.py`` commands run at batch priority, where they leave some tokens (and some of reddit's
+allowance) for interactive requests, and wait as long as it takes.
+"""
+
+from contextlib import contextmanager
+
+import praw
+import threading
+import time
+
+import redis
+
+from . import metrics, shared
+from .app import app
+
+logger = app.logger.getChild('ratelimit')
+
+_bucket_key = shared.key('ratelimit', 'bucket')
+_reddit_key = shared.key('ratelimit', 'reddit')
+
+_context = threading.local()
+_made = {'n': 0}
+_made_lock = threading.Lock()
+
+_TAKE = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local reserve_remaining = tonumber(ARGV[5])
+
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+redis.call('hmset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('expire', KEYS[1], 3600)
+
+local reddit = redis.call('hmget', KEYS[2], 'remaining', 'reset_at')
+local remaining = tonumber(reddit[1])
+local reset_at = tonumber(reddit[2])
+local limited = remaining ~= nil and reset_at ~= nil and reset_at > now
+if limited and remaining < 1 + reserve_remaining then
+    return tostring(reset_at - now)
+end
+if tokens < 1 + reserve then
+    return tostring((1 + reserve - tokens) / rate)
+end
+
+redis.call('hset', KEYS[1], 'tokens', tokens - 1)
+if limited then
+    redis.call('hincrbyfloat', KEYS[2], 'remaining', -1)
+end
+return '0'
+"""
+
+
+def current_priority():
+    return getattr(_context, 'priority', 'interactive')
+
+
+@contextmanager
+def priority(level):
+    """Run the enclosed reddit requests at *level*, ``'interactive'`` or ``'batch'``."""
+    previous = current_priority()
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def acquire():
+    """Wait for our turn to make a request to reddit."""
+    if app.config['REDDIT_REPLAY']:
+        return  # nothing's going to reddit
+    batch = current_priority() == 'batch'
+    reserve = app.config['REDDIT_BATCH_RESERVE'] if batch else 0
+    reserve_remaining = app.config['REDDIT_BATCH_RESERVE_REMAINING'] if batch else 0
+    deadline = None if batch else time.time() + app.config['REDDIT_INTERACTIVE_MAX_WAIT']
+    waited = False
+    while True:
+        try:
+            wait = float(shared.script(_TAKE)(
+                keys=[_bucket_key, _reddit_key],
+                args=[repr(time.time()), app.config['REDDIT_RATE'], app.config['REDDIT_BURST'],
+                      reserve, reserve_remaining]))
+        except redis.RedisError:
+            logger.exception("couldn't reach the rate limiter, going ahead anyway")
+            return
+        if wait <= 0:
+            break
+        if deadline is not None and time.time() + wait > deadline:
+            # someone's waiting for this page; better to risk a 429 than time out
+            shared.incr('ratelimit', 'overdrawn')
+            break
+        waited = True
+        time.sleep(min(wait, 5))
+    if waited:
+        shared.incr('ratelimit', 'waited_' + current_priority())
+    with _made_lock:
+        _made['n'] += 1
+
+
+def requests_made():
+    """How many requests this process has made to reddit."""
+    return _made['n']
+
+
+def observe(response):
+    """Take note of what reddit says about our rate limit."""
+    if app.config['REDDIT_REPLAY']:
+        return
+    remaining = response.headers.get('x-ratelimit-remaining')
+    reset = response.headers.get('x-ratelimit-reset')
+    if response.status_code == 429:
+        shared.incr('ratelimit', 'throttled')
+        remaining = 0
+        reset = reset or response.headers.get('retry-after') or 60
+    if remaining is None or reset is None:
+        return
+    try:
+        pipe = shared.store.pipeline(transaction=False)
+        pipe.hmset(_reddit_key, {'remaining': float(remaining), 'reset_at': time.time() + float(reset)})
+        pipe.expire(_reddit_key, int(float(reset)) + 1)
+        pipe.execute()
+    except (ValueError, redis.RedisError):
+        logger.exception("couldn't record rate limit headers %r/%r", remaining, reset)
+
+
+class Handler(praw.handlers.DefaultHandler):
+    """praw's handler, with its per-process spacing of requests replaced by the shared bucket."""
+
+    def _send(self, request, proxies, timeout, verify, **_):
+        acquire()
+        settings = self.http.merge_environment_settings(request.url, proxies, False, verify, None)
+        start = time.time()
+        response = self.http.send(request, timeout=timeout, allow_redirects=False, **settings)
+        metrics.observe_reddit(request.method, request.url, response.status_code, time.time() - start)
+        observe(response)
+        return response
+
+Handler.request = praw.handlers.DefaultHandler.with_cache(Handler._send)
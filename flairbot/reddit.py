@@ -1,81 +1,543 @@
 from flask import session
 
-import cssutils
-import cssutils.css
+from collections import Counter
+
+import hashlib
+import json
 import praw
-import requests
+import threading
 import time
+import zlib
 
+from . import css, localcache, memo, metrics, ratelimit, replay, shared, tasks
 from .app import app, cache
 
 logger = app.logger.getChild('reddit')
 
 moderator_scopes = {'identity', 'mysubreddits', 'modflair', 'flair'}
 
+user_agent = '/u/mindcrack_flair_bot, by /u/edk141'
+
 _access_expiry = -1
 _access_info = None
 
+# praw clients aren't thread-safe, so the pool is per-thread as well as per-worker
+_pool = threading.local()
 
-def get(user_from_session=False, moderator=False, refresh_token=None):
+_token_key = shared.key('oauth', 'moderator')
+
+
+def _bind(r, scope, access_token, refresh_token):
+    # set_access_credentials makes a request to look up the user, so avoid repeating it
+    if r.access_token != access_token:
+        r.set_access_credentials(scope, access_token, refresh_token)
+
+
+def _load_token():
+    stored = shared.store.get(_token_key)
+    if stored is None:
+        return None
+    return json.loads(stored.decode('utf8'))
+
+
+def _refresh_token(r, refresh_token):
+    info = r.refresh_access_information(refresh_token)
+    now = time.time()
+    stored = {'access_token': info['access_token'],
+              'refresh_token': info['refresh_token'],
+              'refresh_at': now + 3300,  # give ourselves a 5-minute margin
+              'expires_at': now + 3600}
+    if not replay.replaying():
+        # a replayed token is no use to anyone else
+        shared.store.setex(_token_key, 3600, json.dumps(stored))
+    shared.incr('oauth', 'refresh')
+    return stored
+
+
+def _moderator_token(r, refresh_token):
+    """Set up *r* with the moderator's access token.
+
+    The token is kept in redis so all the workers share it. When it's due for renewal one worker
+    refreshes it while the others keep using the old one, which is still good for a few minutes.
+    """
     global _access_info, _access_expiry
 
-    r = praw.Reddit('/u/mindcrack_flair_bot, by /u/edk141', disable_update_check=True)
+    now = time.time()
+    if _access_info is not None and _access_expiry > now:
+        shared.incr('oauth', 'local_hit')
+        _bind(r, moderator_scopes, *_access_info)
+        return
+
+    stored = _load_token()
+    if stored is None or stored['refresh_at'] <= now:
+        lock = shared.Lock('oauth_moderator', timeout=30)
+        if lock.acquire():
+            try:
+                # someone may have finished a refresh while we were checking
+                stored = _load_token()
+                if stored is None or stored['refresh_at'] <= now:
+                    stored = _refresh_token(r, refresh_token)
+                    _access_info = (stored['access_token'], stored['refresh_token'])
+                    _access_expiry = stored['refresh_at']
+                    return
+            finally:
+                lock.release()
+        elif stored is not None and stored['expires_at'] > now + 10:
+            # another worker is refreshing; the old token will do for now. check again shortly
+            shared.incr('oauth', 'stale')
+            _access_info = (stored['access_token'], stored['refresh_token'])
+            _access_expiry = now + 5
+            _bind(r, moderator_scopes, *_access_info)
+            return
+        else:
+            shared.incr('oauth', 'wait')
+            deadline = now + 10
+            while time.time() < deadline:
+                time.sleep(0.1)
+                stored = _load_token()
+                if stored is not None and stored['refresh_at'] > now:
+                    break
+            else:
+                logger.warning('timed out waiting for another worker to refresh the moderator token')
+                stored = _refresh_token(r, refresh_token)
+                _access_info = (stored['access_token'], stored['refresh_token'])
+                _access_expiry = stored['refresh_at']
+                return
+    else:
+        shared.incr('oauth', 'hit')
+
+    _access_info = (stored['access_token'], stored['refresh_token'])
+    _access_expiry = stored['refresh_at']
+    _bind(r, moderator_scopes, *_access_info)
+
+
+def _new_client(handler=None):
+    r = praw.Reddit(user_agent, handler=handler, disable_update_check=True)
+    if app.config['REDDIT_URL']:
+        r.config.api_url = r.config.permalink_url = r.config.oauth_url = app.config['REDDIT_URL']
     r.set_oauth_app_info(app.config['REDDIT_CLIENT_ID'],
                          app.config['REDDIT_CLIENT_SECRET'],
                          app.config['REDDIT_REDIRECT_URI'])
-    if user_from_session:
+    return r
+
+
+def _handler():
+    if getattr(_pool, 'handler', None) is None:
+        # the handler owns the HTTP session, so sharing it between clients shares keep-alive
+        # connections as well
+        _pool.handler = ratelimit.Handler()
+        _pool.handler.http.headers['User-Agent'] = user_agent
+        replay.install(_pool.handler.http)
+        _pool.clients = {}
+    return _pool.handler
+
+
+def _client(role):
+    handler = _handler()
+    r = _pool.clients.get(role)
+    if r is None:
+        r = _pool.clients[role] = _new_client(handler)
+    return r
+
+
+def http():
+    """The requests session used for reddit on this thread."""
+    return _handler().http
+
+
+def get(user_from_session=False, moderator=False, refresh_token=None):
+    """Return a praw client with the requested credentials.
+
+    Clients are reused for the life of the worker, so don't hold on to one across requests or
+    hand it to another thread.
+    """
+    if refresh_token is not None:
+        r = _new_client(_handler())
+        r.refresh_access_information(refresh_token)
+    elif user_from_session:
+        r = _client('user')
         credentials = session['REDDIT_CREDENTIALS']
-        r.set_access_credentials(set(credentials['scope']),
-                                 credentials['access_token'],
-                                 credentials['refresh_token'])
+        _bind(r, set(credentials['scope']),
+              credentials['access_token'],
+              credentials['refresh_token'])
     elif moderator:
-        if _access_info is not None and _access_expiry > time.time():
-            r.set_access_credentials(moderator_scopes, *_access_info)
-        else:
-            if refresh_token is None:
-                refresh_token = app.config['REDDIT_REFRESH_TOKEN']
-            info = r.refresh_access_information(refresh_token)
-            _access_info = (info['access_token'], info['refresh_token'])
-            _access_expiry = time.time() + 3300  # give ourselves a 5-minute margin
+        r = _client('moderator')
+        _moderator_token(r, app.config['REDDIT_REFRESH_TOKEN'])
+    else:
+        r = _client('anonymous')
+        if r.is_oauth_session():
+            # oauth_handler logs this client in as the user
+            r.clear_authentication()
     return r
 
 
-@cache.cached(timeout=app.config['CACHE_TIME_LONG'], key_prefix='reddit_stylesheet_cache')
-def get_stylesheet():
+def _gzip(data):
+    z = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return z.compress(data) + z.flush()
+
+
+def _fetch_stylesheet(previous):
+    """Fetch the stylesheet, conditionally if we've got a *previous* copy.
+
+    Returns a dict with the flair css (``css``, and ``gzip``ped), a hash of it (``etag``), and the
+    upstream validators for next time.
+    """
+    headers = {}
+    if previous is not None:
+        if previous.get('upstream_etag'):
+            headers['If-None-Match'] = previous['upstream_etag']
+        if previous.get('upstream_modified'):
+            headers['If-Modified-Since'] = previous['upstream_modified']
+    url = '{}/r/{}/stylesheet.css'.format(
+        app.config['REDDIT_URL'] or 'https://www.reddit.com',
+        app.config.get('STYLE_SUBREDDIT', app.config['REDDIT_SUBREDDIT']))
     tries = 3
-    while tries > 0:
-        time.sleep(3)
-        r = requests.get('http://www.reddit.com/r/{}/stylesheet.css'.format(
-                app.config.get('STYLE_SUBREDDIT', app.config['REDDIT_SUBREDDIT'])))
-        if r.status_code == 200:
+    while True:
+        ratelimit.acquire()
+        start = time.time()
+        r = http().get(url, headers=headers)
+        metrics.observe_reddit('GET', url, r.status_code, time.time() - start)
+        ratelimit.observe(r)
+        if r.status_code in (200, 304):
             break
         tries -= 1
-    sheet = cssutils.parseString(r.text)
-    new = cssutils.css.CSSStyleSheet()
-    for rule in sheet.cssRules.rulesOfType(cssutils.css.CSSRule.STYLE_RULE):
-        for selector in rule.selectorList:
-            if selector.selectorText == 'content':
-                selector.selectorText = '.flair'
-            if selector.selectorText.startswith('.flair'):
-                new.add(rule)
-    return new.cssText
-
-
-@cache.memoize(timeout=app.config['CACHE_TIME_SHORT'])
+        if tries == 0:
+            logger.warning('giving up on the stylesheet after status %d', r.status_code)
+            if previous is not None:
+                return previous
+            # nothing to serve; try again in a minute rather than on every request
+            sheet = b''
+            return {'css': sheet, 'gzip': _gzip(sheet), 'etag': hashlib.sha1(sheet).hexdigest(),
+                    'fetched': time.time() - app.config['CACHE_TIME_LONG'] + 60}
+        time.sleep(3)
+    if r.status_code == 304 and previous is not None:
+        shared.incr('stylesheet', 'not_modified')
+        previous['fetched'] = time.time()
+        return previous
+    shared.incr('stylesheet', 'fetch')
+    sheet = css.flair_rules(r.text).encode('utf8')
+    return {'css': sheet,
+            'gzip': _gzip(sheet),
+            'etag': hashlib.sha1(sheet).hexdigest(),
+            'upstream_etag': r.headers.get('ETag'),
+            'upstream_modified': r.headers.get('Last-Modified'),
+            'fetched': time.time()}
+
+
+def _stylesheet_stale(sheet):
+    return sheet['fetched'] + app.config['CACHE_TIME_LONG'] < time.time()
+
+
+@tasks.job()
+def refresh_stylesheet():
+    lock = shared.Lock('stylesheet', timeout=60)
+    if not lock.acquire():
+        return
+    try:
+        sheet = cache.get('reddit_stylesheet')
+        if sheet is None or _stylesheet_stale(sheet):
+            localcache.set('reddit_stylesheet', _fetch_stylesheet(sheet), timeout=app.config['CACHE_TIME_STALE'])
+    finally:
+        lock.release()
+
+
+def get_stylesheet():
+    """Return the flair stylesheet, as described in _fetch_stylesheet.
+
+    Once we have a copy it's always served straight away. If it's out of date, a fresh one is
+    fetched in the background.
+    """
+    sheet = localcache.get('reddit_stylesheet', timeout=app.config['CACHE_TIME_STALE'])
+    if sheet is None:
+        with shared.Lock('stylesheet', timeout=60):
+            sheet = cache.get('reddit_stylesheet')
+            if sheet is None:
+                sheet = _fetch_stylesheet(None)
+                localcache.set('reddit_stylesheet', sheet, timeout=app.config['CACHE_TIME_STALE'])
+    elif _stylesheet_stale(sheet):
+        shared.incr('stylesheet', 'stale')
+        if shared.store.set(shared.key('stylesheet', 'kicked'), 1, ex=60, nx=True):
+            tasks.kick('refresh_stylesheet')
+    return sheet
+
+
 def _get_flair(name):
+    shared.incr('flair', 'fetch')
     return get(moderator=True).get_flair(app.config['REDDIT_SUBREDDIT'], name)
 
 
+# The flair mirror is a copy of the subreddit's whole flair list, in a redis hash of lowercased
+# name -> json. It's rebuilt a few pages at a time by sync_flair_mirror; our own flair changes are
+# written straight through. Anything else changed on reddit only shows up in the next pass, so
+# get_flair only trusts the mirror while everything in it was fetched within CACHE_TIME_SHORT.
+_mirror_key = shared.key('flair_mirror')
+_mirror_next_key = shared.key('flair_mirror', 'next')
+_mirror_written_key = shared.key('flair_mirror', 'written')  # written through during this pass
+_mirror_state_key = shared.key('flair_mirror', 'state')
+
+# a page fetched before a write-through mustn't put the old flair back afterwards
+_MIRROR_PAGE = """
+for i = 1, #ARGV, 2 do
+    if redis.call('sismember', KEYS[2], ARGV[i]) == 0 then
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+
+@praw.decorators.restrict_access('modflair')
+def _get_flair_page(r, subreddit, after=None):
+    params = {'limit': 1000}
+    if after is not None:
+        params['after'] = after
+    return r.request_json(r.config['flairlist'].format(subreddit=subreddit), params=params)
+
+
+def _mirror_entry(flair):
+    return json.dumps({'user': flair['user'],
+                       'flair_text': flair.get('flair_text'),
+                       'flair_css_class': flair.get('flair_css_class')})
+
+
+def _mirror_get(names):
+    """{name: flair} for those of *names* the mirror has, in one round trip."""
+    pipe = shared.store.pipeline(transaction=False)
+    pipe.hmget(_mirror_key, names)
+    pipe.hget(_mirror_state_key, 'synced')
+    entries, synced = pipe.execute()
+    max_age = min(app.config['FLAIR_MIRROR_MAX_AGE'], app.config['CACHE_TIME_SHORT'])
+    if synced is None or float(synced) + max_age < time.time():
+        return {}
+    # anyone not in the flair list has no flair - or no account. only reddit can tell us which
+    found = {name: json.loads(entry.decode('utf8'))
+             for name, entry in zip(names, entries) if entry is not None}
+    if found:
+        shared.incr('flair_mirror', 'hit', len(found))
+        metrics.cache_lookup('get_flair', 'mirror', len(found))
+    return found
+
+
+def _mirror_put(flairs):
+    """Write {name: flair} through to the mirror."""
+    pipe = shared.store.pipeline()
+    for name, flair in flairs.items():
+        pipe.sadd(_mirror_written_key, name)
+        if flair is None or not (flair.get('flair_text') or flair.get('flair_css_class')):
+            pipe.hdel(_mirror_key, name)
+            pipe.hdel(_mirror_next_key, name)
+        else:
+            pipe.hset(_mirror_key, name, _mirror_entry(flair))
+            pipe.hset(_mirror_next_key, name, _mirror_entry(flair))
+    pipe.execute()
+
+
+@tasks.job(app.config['FLAIR_MIRROR_INTERVAL'])
+def sync_flair_mirror(full=False):
+    """Fetch the next few pages of the flair list into the mirror, or with *full*, the rest of it.
+
+    A full pass is collected in a separate hash and swapped in when it's complete, so users who
+    lose their flair drop out of the mirror. The mirror counts as synced as of when that pass
+    started, since that's how old the oldest page in it is.
+    """
+    pages = app.config['FLAIR_MIRROR_PAGES']
+    lock = shared.Lock('flair_mirror', timeout=600)
+    if not lock.acquire():
+        return
+    try:
+        r = get(moderator=True)
+        after = shared.store.hget(_mirror_state_key, 'after')
+        if after is None:
+            pipe = shared.store.pipeline()
+            pipe.delete(_mirror_next_key, _mirror_written_key)
+            pipe.hset(_mirror_state_key, 'started', time.time())
+            pipe.execute()
+        else:
+            after = after.decode('utf8')
+        while full or pages > 0:
+            data = _get_flair_page(r, app.config['REDDIT_SUBREDDIT'], after)
+            shared.incr('flair_mirror', 'page')
+            if data['users']:
+                args = []
+                for f in data['users']:
+                    args.extend((f['user'].lower(), _mirror_entry(f)))
+                shared.script(_MIRROR_PAGE)(keys=[_mirror_next_key, _mirror_written_key], args=args)
+            after = data.get('next')
+            if after is None:
+                started = shared.store.hget(_mirror_state_key, 'started')
+                pipe = shared.store.pipeline()
+                if shared.store.exists(_mirror_next_key):
+                    pipe.rename(_mirror_next_key, _mirror_key)
+                else:
+                    pipe.delete(_mirror_key)
+                pipe.delete(_mirror_written_key)
+                pipe.hdel(_mirror_state_key, 'after', 'started')
+                pipe.hset(_mirror_state_key, 'synced', float(started) if started else time.time())
+                pipe.execute()
+                shared.incr('flair_mirror', 'pass')
+                return
+            shared.store.hset(_mirror_state_key, 'after', after)
+            pages -= 1
+    finally:
+        lock.release()
+
+
+def iter_flair_list(from_reddit=False):
+    """Every user's flair: from the mirror if it's up to date (and *from_reddit* isn't set),
+    otherwise straight from reddit."""
+    synced = shared.store.hget(_mirror_state_key, 'synced')
+    if from_reddit or synced is None or float(synced) + app.config['FLAIR_MIRROR_MAX_AGE'] < time.time():
+        for flair in get(moderator=True).get_flair_list(app.config['REDDIT_SUBREDDIT'], limit=None):
+            yield flair
+        return
+    cursor = 0
+    while True:
+        cursor, entries = shared.store.hscan(_mirror_key, cursor, count=1000)
+        for entry in entries.values():
+            yield json.loads(entry.decode('utf8'))
+        if int(cursor) == 0:
+            break
+
+
+# usernames can't contain a colon, so neither prefix can be mistaken for the other plus a name
+def _flair_key(name):
+    return 'flair:' + name
+
+
+def _missing_key(name):
+    # the cache can't hold None, so users with no flair (or no account) are remembered separately
+    return 'flairmissing:' + name
+
+
+def _cached_flairs(names):
+    """Look *names* up in the cache with one MGET, without asking reddit.
+
+    Returns ``({name: flair or None}, [names the cache doesn't know])``.
+    """
+    keys = []
+    for name in names:
+        keys.extend((_flair_key(name), _missing_key(name)))
+    values = cache.get_many(*keys)
+    found = {}
+    misses = []
+    counts = Counter()
+    for i, name in enumerate(names):
+        flair, missing = values[2 * i], values[2 * i + 1]
+        if flair is not None:
+            found[name] = flair
+            counts['hit'] += 1
+        elif missing is not None:
+            found[name] = None
+            counts['negative'] += 1
+        else:
+            misses.append(name)
+            counts['miss'] += 1
+    if counts['negative']:
+        shared.incr('flair', 'negative_hit', counts['negative'])
+    for result, n in counts.items():
+        metrics.cache_lookup('get_flair', result, n)
+    return found, misses
+
+
+def _store_flairs(flairs, replace=False):
+    """Cache {name: flair or None} fresh from reddit. With *replace*, also drop whatever was cached
+    for them before (otherwise there wasn't anything)."""
+    found = {_flair_key(name): flair for name, flair in flairs.items() if flair is not None}
+    missing = {_missing_key(name): True for name, flair in flairs.items() if flair is None}
+    if found:
+        cache.set_many(found, timeout=app.config['CACHE_TIME_SHORT'])
+    if missing:
+        cache.set_many(missing, timeout=app.config['CACHE_TIME_NEGATIVE'])
+    if replace:
+        stale = ([_missing_key(name) for name, flair in flairs.items() if flair is not None] +
+                 [_flair_key(name) for name, flair in flairs.items() if flair is None])
+        if stale:
+            cache.delete_many(*stale)
+
+
+def _fetch_flairs(names):
+    """Ask reddit about each of *names*, and cache the answers."""
+    flairs = {name: _get_flair(name) for name in names}
+    _store_flairs(flairs)
+    return flairs
+
+
+def _lookup_flairs(names):
+    found, misses = _cached_flairs(names)
+    if not misses:
+        return found
+    # only one worker asks reddit about a given user at a time; the rest wait for its answer
+    ours, theirs = [], []
+    for name in misses:
+        lock = shared.Lock('flair:' + name, timeout=10)
+        (ours if lock.acquire() else theirs).append((name, lock))
+    try:
+        if ours:
+            # whoever held a lock may have cached the answer between our MGET and taking it
+            cached, misses = _cached_flairs([name for name, _ in ours])
+            found.update(cached)
+            found.update(_fetch_flairs(misses))
+    finally:
+        for _, lock in ours:
+            lock.release()
+    if theirs:
+        shared.incr('flair', 'coalesced', len(theirs))
+        try:
+            # one deadline for the lot, not one per name; past it, ask reddit ourselves
+            deadline = time.time() + 10
+            for _, lock in theirs:
+                lock.acquire(blocking=True, wait=max(deadline - time.time(), 0))
+            cached, misses = _cached_flairs([name for name, _ in theirs])
+            found.update(cached)
+            found.update(_fetch_flairs(misses))
+        finally:
+            for _, lock in theirs:
+                lock.release()
+    return found
+
+
 def _uncache_flair(name):
     name = name.lower()
-    cache.delete_memoized(_get_flair, name)
+    memo.forget(('get_flair', name))
+    cache.delete_many(_flair_key(name), _missing_key(name))
+    shared.store.hdel(_mirror_key, name)
 
 
-def get_flair(name, no_cache=False):
-    name = name.lower()
+def _get_flairs_cached(names):
+    flairs = _mirror_get(names)
+    rest = [name for name in names if name not in flairs]
+    if rest:
+        flairs.update(_lookup_flairs(rest))
+    return flairs
+
+
+def _fetch_flairs_fresh(names):
+    flairs = {name: _get_flair(name) for name in names}
+    _store_flairs(flairs, replace=True)
+    _mirror_put(flairs)
+    for name, flair in flairs.items():
+        memo.put(('get_flair', name), flair)
+    return flairs
+
+
+def get_flairs(names, no_cache=False):
+    """Flair for each of *names*, as ``{name: flair or None}``.
+
+    The same as calling get_flair for each name, but the mirror and the cache are each read in one
+    round trip however many names there are, and whatever has to come from reddit is written back
+    together.
+    """
+    lowered = sorted({name.lower() for name in names})
     if no_cache:
-        _uncache_flair(name)
-    return _get_flair(name)
+        flairs = _fetch_flairs_fresh(lowered)
+    else:
+        flairs = memo.get_many('get_flair', lowered, _get_flairs_cached)
+    # callers are welcome to change what they get, but not the remembered copies
+    return {name: dict(flairs[name.lower()]) if flairs[name.lower()] is not None else None
+            for name in names}
+
+
+def get_flair(name, no_cache=False):
+    return get_flairs([name], no_cache)[name]
 
 
 def update_flair_cache(name, flair):
@@ -87,20 +549,25 @@ def update_flair_cache(name, flair):
         if flair.get('user'):
             _uncache_flair(flair['user'])
         return
-    key = _get_flair.make_cache_key(_get_flair.uncached, name)
-    cache.set(key, flair, timeout=_get_flair.cache_timeout)
+    name = name.lower()
+    _store_flairs({name: flair}, replace=True)
+    _mirror_put({name: flair})
+    memo.put(('get_flair', name), dict(flair))
 
 
-@cache.cached(timeout=app.config['CACHE_TIME_LONG'], key_prefix='reddit_moderator_cache')
+@memo.per_request
+@localcache.cached('reddit_moderator_cache', timeout=app.config['CACHE_TIME_LONG'])
 def get_moderators():
     return {u.name for u in get().get_moderators(app.config['REDDIT_SUBREDDIT'])}
 
 
-@cache.cached(timeout=app.config['CACHE_TIME_LONG'], key_prefix='reddit_me_cache')
+@memo.per_request
+@localcache.cached('reddit_me_cache', timeout=app.config['CACHE_TIME_LONG'])
 def get_me():
     return get(moderator=True).get_me().name
 
 
-@cache.cached(timeout=app.config['CACHE_TIME_LONG'], key_prefix='reddit_mymod_cache')
+@memo.per_request
+@localcache.cached('reddit_mymod_cache', timeout=app.config['CACHE_TIME_LONG'])
 def get_my_moderation():
     return [s.url for s in get(moderator=True).get_my_moderation()]
@@ -0,0 +1,264 @@
+"""Record our traffic with reddit, and play it back later.
+
+With ``REDDIT_RECORD`` set to a path, every request to reddit and its response are appended to
+that file: gzipped JSON, one line per request. Tokens, secrets and the like are scrubbed first, and
+only the response headers we look at are kept.
+
+With ``REDDIT_REPLAY`` set to such a file, nothing goes to reddit. Each request is answered with
+the recorded response to the same request (method, URL and form data; the same request recorded
+several times gets its answers in the order they were recorded). Unless ``REDDIT_REPLAY_LATENCY``
+is turned off, each answer takes as long as the original did, so the app can be profiled with or
+without reddit's share of the time.
+
+Both work by mounting a ``requests`` transport adapter on the sessions in ``reddit``'s pool, so
+praw and the stylesheet fetch are covered alike.
+
+What reddit is asked can depend on what's already in the database, so ``save_state`` keeps that
+in the recording too, for the replay to start from (see ``manage.py stats``).
+"""
+
+from datetime import datetime
+
+import atexit
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+from .app import app
+
+logger = app.logger.getChild('replay')
+
+SECRET_FIELDS = {'access_token', 'refresh_token', 'code', 'password', 'passwd', 'client_secret',
+                 'modhash', 'uh'}
+KEEP_HEADERS = {'content-type', 'etag', 'last-modified', 'retry-after',
+                'x-ratelimit-remaining', 'x-ratelimit-reset', 'x-ratelimit-used'}
+FLUSH_EVERY = 50
+
+SCRUBBED = 'scrubbed'
+
+
+def _scrub_pairs(pairs):
+    return sorted((k, SCRUBBED if k in SECRET_FIELDS else v) for k, v in pairs)
+
+
+def _scrub_url(url):
+    parts = urlsplit(url)
+    query = urlencode(_scrub_pairs(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+def _scrub_body(body):
+    if body is None:
+        return ''
+    if isinstance(body, bytes):
+        body = body.decode('utf8', 'replace')
+    return urlencode(_scrub_pairs(parse_qsl(body, keep_blank_values=True)))
+
+
+def _scrub_content(content):
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if isinstance(data, dict) and SECRET_FIELDS & set(data):
+        for field in SECRET_FIELDS & set(data):
+            data[field] = SCRUBBED
+        return json.dumps(data)
+    return content
+
+
+def _key(method, url, body):
+    return hashlib.sha1('{} {} {}'.format(method, url, body).encode('utf8')).hexdigest()
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    """Passes requests on to reddit, and writes them and their responses to *path*."""
+
+    def __init__(self, path, **kw):
+        super(RecordingAdapter, self).__init__(**kw)
+        self.path = path
+
+    def send(self, request, **kw):
+        start = time.time()
+        response = super(RecordingAdapter, self).send(request, **kw)
+        url = _scrub_url(request.url)
+        body = _scrub_body(request.body)
+        _archive.add({'key': _key(request.method, url, body),
+                      'method': request.method,
+                      'url': url,
+                      'at': start,
+                      'elapsed': round(time.time() - start, 4),
+                      'status': response.status_code,
+                      'headers': {k.lower(): v for k, v in response.headers.items()
+                                  if k.lower() in KEEP_HEADERS},
+                      'content': _scrub_content(response.content.decode('utf8', 'replace'))},
+                     self.path)
+        return response
+
+
+class _Archive(object):
+    """Records waiting to be written. Each flush appends a gzip member, which gzip readers see as
+    one file."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.registered = False
+
+    def add(self, record, path):
+        with self.lock:
+            self.pending.append(json.dumps(record, sort_keys=True))
+            if len(self.pending) >= FLUSH_EVERY:
+                self._flush(path)
+
+    def flush(self, path):
+        with self.lock:
+            self._flush(path)
+
+    def _flush(self, path):
+        if not self.pending:
+            return
+        data = io.BytesIO()
+        with gzip.GzipFile(fileobj=data, mode='wb') as z:
+            z.write(('\n'.join(self.pending) + '\n').encode('utf8'))
+        with open(path, 'ab') as f:
+            f.write(data.getvalue())
+        self.pending = []
+
+_archive = _Archive()
+
+
+def load(path):
+    """The records in *path*, oldest first."""
+    with gzip.open(path, 'rb') as f:
+        records = [json.loads(line.decode('utf8')) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r['at'])
+
+
+_loaded = {}
+
+
+def _records(path):
+    # a recording is read once per process, however many things want to look at it
+    if path not in _loaded:
+        _loaded[path] = load(path)
+    return _loaded[path]
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """Answers requests from the recording at *path*."""
+
+    def __init__(self, path, latency=True, scopes=()):
+        super(ReplayAdapter, self).__init__()
+        self.latency = latency
+        self.scopes = scopes
+        self.lock = threading.Lock()
+        self.answers = {}
+        for record in _records(path):
+            if 'key' in record:
+                self.answers.setdefault(record['key'], []).append(record)
+
+    def _next(self, key):
+        with self.lock:
+            answers = self.answers.get(key)
+            if not answers:
+                return None
+            # the last answer for a request stands for any more times it's asked
+            return answers.pop(0) if len(answers) > 1 else answers[0]
+
+    def send(self, request, **kw):
+        url = _scrub_url(request.url)
+        record = self._next(_key(request.method, url, _scrub_body(request.body)))
+        if record is None and urlsplit(url).path.endswith('/api/v1/access_token/'):
+            # the recording may have used a token it already had
+            record = {'elapsed': 0, 'status': 200, 'headers': {'content-type': 'application/json'},
+                      'content': json.dumps({'access_token': SCRUBBED, 'refresh_token': SCRUBBED,
+                                             'token_type': 'bearer', 'expires_in': 3600,
+                                             'scope': ' '.join(sorted(self.scopes))})}
+        if record is None:
+            raise requests.ConnectionError('{} {} was not recorded'.format(request.method, url),
+                                           request=request)
+        if self.latency:
+            time.sleep(record['elapsed'])
+        response = requests.Response()
+        response.status_code = record['status']
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response._content = record['content'].encode('utf8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = ''
+        return response
+
+    def close(self):
+        pass
+
+
+_replay = {}
+
+
+def install(session):
+    """Mount the recording or replaying adapter on *session*, if either is configured."""
+    if app.config['REDDIT_REPLAY']:
+        path = app.config['REDDIT_REPLAY']
+        if path not in _replay:
+            from .reddit import moderator_scopes
+            _replay[path] = ReplayAdapter(path, app.config['REDDIT_REPLAY_LATENCY'], moderator_scopes)
+        adapter = _replay[path]
+    elif app.config['REDDIT_RECORD']:
+        adapter = RecordingAdapter(app.config['REDDIT_RECORD'])
+        if not _archive.registered:
+            atexit.register(flush)
+            _archive.registered = True
+    else:
+        return
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def flush():
+    """Write out anything recorded that hasn't been yet."""
+    if app.config['REDDIT_RECORD']:
+        _archive.flush(app.config['REDDIT_RECORD'])
+
+
+def save_state(name, data):
+    """Keep *data* in the recording under *name*, if we're recording."""
+    if app.config['REDDIT_RECORD']:
+        _archive.add({'state': name, 'at': time.time(), 'data': data}, app.config['REDDIT_RECORD'])
+        flush()
+
+
+def state(name):
+    """What save_state kept under *name* in the recording we're replaying, or None."""
+    for record in _records(app.config['REDDIT_REPLAY']):
+        if record.get('state') == name:
+            return record['data']
+    return None
+
+
+def replaying():
+    return bool(app.config['REDDIT_REPLAY'])
+
+
+def now():
+    """The current time, or when the recording started if we're replaying one, so anything that
+    depends on the date sees the same data it did then."""
+    if replaying():
+        records = _records(app.config['REDDIT_REPLAY'])
+        if records:
+            return datetime.utcfromtimestamp(records[0]['at'])
+    return datetime.utcnow()
@@ -0,0 +1,96 @@
+"""State shared between uWSGI workers, kept in redis.
+
+Keys live under ``flairbot:`` so they don't get mixed up with Flask-Cache's ``flairbot_`` keys.
+"""
+
+import binascii
+import os
+import time
+
+import redis
+
+from .app import app
+
+store = redis.StrictRedis.from_url(app.config['REDIS_URL'])
+
+KEY_PREFIX = 'flairbot:'
+
+_scripts = {}
+_known_families = set()
+
+
+def key(*parts):
+    return KEY_PREFIX + ':'.join(parts)
+
+
+def script(source):
+    # redis-py loads scripts as soon as they're registered, so don't do it at import time
+    if source not in _scripts:
+        _scripts[source] = store.register_script(source)
+    return _scripts[source]
+
+
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Lock(object):
+    """A lock held in redis. It expires after *timeout* seconds, so a worker that dies while
+    holding it can't wedge everyone else."""
+
+    def __init__(self, name, timeout=30):
+        self.name = key('lock', name)
+        self.timeout = timeout
+        self.token = None
+
+    def acquire(self, blocking=False, wait=None):
+        token = binascii.hexlify(os.urandom(8))
+        deadline = time.time() + (self.timeout if wait is None else wait)
+        while True:
+            if store.set(self.name, token, ex=self.timeout, nx=True):
+                self.token = token
+                return True
+            if not blocking or time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def release(self):
+        if self.token is not None:
+            script(_RELEASE)(keys=[self.name], args=[self.token])
+            self.token = None
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def incr(family, field, amount=1):
+    """Bump a counter. Counters are informational, so a redis failure is ignored."""
+    try:
+        pipe = store.pipeline(transaction=False)
+        if family not in _known_families:
+            pipe.sadd(key('stats'), family)
+        pipe.hincrby(key('stats', family), field, amount)
+        pipe.execute()
+        _known_families.add(family)
+    except redis.RedisError:
+        pass
+
+
+def counters():
+    """Return every counter, as ``{family: {field: value}}``."""
+    families = sorted(f.decode('utf8') for f in store.smembers(key('stats')))
+    pipe = store.pipeline(transaction=False)
+    for family in families:
+        pipe.hgetall(key('stats', family))
+    result = {}
+    for family, values in zip(families, pipe.execute()):
+        result[family] = {k.decode('utf8'): int(v) for k, v in values.items()}
+    return result
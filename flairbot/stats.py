@@ -0,0 +1,269 @@
+"""The activity crawl for ``manage.py stats``.
+
+The flair each recent poster last had is kept in the database, so each run only has to look at
+what's happened since the last one: new submissions, and the newest comments. If reddit's comment
+listing doesn't go back far enough, or a submission's comment count has changed since we counted
+it, its whole comment tree is fetched instead.
+
+Fetching a comment tree takes several requests, and most of the time goes on waiting for reddit.
+So a handful of workers fetch trees at once. Everything runs at batch priority, so the crawl takes
+whatever's left of the reddit rate limit after the site has had what it needs.
+"""
+
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import DateTime, func, or_
+
+import praw
+import sys
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import ratelimit, reddit, tasks
+from .app import app, db
+from .models import StatsAuthor, StatsCursor, StatsSubmission
+
+logger = app.logger.getChild('stats')
+
+
+def _observation(thing):
+    """(author, flair text, flair css, when) for a submission or comment, or None if it's deleted."""
+    if thing.author is None:
+        return None
+    return (thing.author.name, thing.author_flair_text, thing.author_flair_css_class,
+            datetime.utcfromtimestamp(thing.created_utc))
+
+
+class Crawl(object):
+    """Fetch the comment trees of the submissions *ids*, *workers* at a time."""
+
+    def __init__(self, ids, workers):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.results = queue.Queue()
+        for id_ in ids:
+            self.queue.put(id_)
+        for _ in range(workers):
+            self.queue.put(None)
+        self.total = len(ids)
+        self.done = 0
+        self.comments = 0
+        self.errors = 0
+
+    def fetch_comments(self):
+        with app.app_context(), ratelimit.priority('batch'):
+            while True:
+                id_ = self.queue.get()
+                if id_ is None:
+                    self.results.put(None)
+                    return
+                try:
+                    s = reddit.get(moderator=True).get_submission(submission_id=id_)
+                    s.replace_more_comments(limit=None, threshold=0)
+                    flat = praw.helpers.flatten_tree(s.comments)
+                except Exception:
+                    logger.exception('fetching comments for %s failed', id_)
+                    self.results.put((id_, None))
+                    continue
+                seen = [_observation(c) for c in flat] + [_observation(s)]
+                self.results.put((id_, [o for o in seen if o is not None]))
+
+    def progress(self, start, requests):
+        elapsed = max(time.time() - start, 1e-6)
+        return ('{}/{} submissions, {} comments, {} errors; '
+                '{:.2f} requests/s, {:.2f} submissions/s'.format(
+                    self.done, self.total, self.comments, self.errors,
+                    (ratelimit.requests_made() - requests) / elapsed, self.done / elapsed))
+
+    def run(self, report_every=10):
+        """Start the workers, and yield (id, observations) for each submission as it's fetched.
+
+        observations is None if the submission couldn't be fetched.
+        """
+        start = last = time.time()
+        requests = ratelimit.requests_made()
+        running = self.workers
+        for _ in range(self.workers):
+            tasks.spawn(self.fetch_comments)
+        while running:
+            try:
+                result = self.results.get(timeout=1)
+            except queue.Empty:
+                result = False
+            if result is None:
+                running -= 1
+            elif result:
+                self.done += 1
+                if result[1] is None:
+                    self.errors += 1
+                else:
+                    self.comments += len(result[1]) - 1
+                yield result
+            if time.time() - last >= report_every:
+                last = time.time()
+                print(self.progress(start, requests))
+                sys.stdout.flush()
+        print(self.progress(start, requests))
+
+
+def _record(observations):
+    """Update StatsAuthor with *observations*, keeping the newest flair seen for each author."""
+    latest = {}
+    for name, flair_text, flair_css, seen in observations:
+        if name not in latest or seen > latest[name][2]:
+            latest[name] = (flair_text, flair_css, seen)
+    names = list(latest)
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        existing = {a.name: a for a in StatsAuthor.query.filter(StatsAuthor.name.in_(chunk))}
+        for name in chunk:
+            flair_text, flair_css, seen = latest[name]
+            author = existing.get(name)
+            if author is None:
+                author = StatsAuthor(name=name)
+                db.session.add(author)
+            elif author.last_seen is not None and author.last_seen >= seen:
+                continue
+            author.flair_text = flair_text
+            author.flair_css_class = flair_css
+            author.last_seen = seen
+
+
+def _list_submissions(r, since):
+    """Note every submission since *since*, with its comment count. Returns how many there were."""
+    known = {s.id: s for s in StatsSubmission.query.filter(StatsSubmission.created >= since)}
+    observations = []
+    n = 0
+    for s in r.get_subreddit(app.config['REDDIT_SUBREDDIT']).get_new(limit=None):
+        created = datetime.utcfromtimestamp(s.created_utc)
+        if created < since:
+            break
+        n += 1
+        row = known.get(s.id)
+        if row is None:
+            row = StatsSubmission(id=s.id, created=created)
+            db.session.add(row)
+        row.num_comments = s.num_comments
+        observations.append(_observation(s))
+    _record([o for o in observations if o is not None])
+    db.session.commit()
+    return n
+
+
+def _read_comments(r, checkpoint, since):
+    """Count the comments newer than *checkpoint*, newest first.
+
+    reddit only lists the last thousand or so comments. Returns (whether we got back as far as
+    *checkpoint*, the time of the newest comment).
+    """
+    observations = []
+    newest = None
+    reached = False
+    for c in r.get_comments(app.config['REDDIT_SUBREDDIT'], limit=None):
+        created = datetime.utcfromtimestamp(c.created_utc)
+        if newest is None:
+            newest = created
+        if checkpoint is not None and created <= checkpoint:
+            reached = True
+            break
+        if created < since:
+            break
+        observation = _observation(c)
+        if observation is not None:
+            observations.append(observation)
+    _record(observations)
+    return reached, newest
+
+
+def update(since, workers=None):
+    """Bring the stats tables up to date, counting activity since *since*.
+
+    Only what's new since the last run is fetched if possible. A run that's interrupted, or that
+    couldn't fetch some comment trees, picks up where it left off next time.
+    """
+    workers = workers or app.config['STATS_WORKERS']
+    r = reddit.get(moderator=True)
+    now = datetime.utcnow()
+
+    print('# listing submissions')
+    print('({} submissions)'.format(_list_submissions(r, since)))
+
+    print('# reading new comments')
+    cursor = StatsCursor.query.get('comments') or StatsCursor(name='comments')
+    reached, newest = _read_comments(r, cursor.position, since)
+    if reached:
+        # every comment since the last run has just been counted, so anything counted then is
+        # up to date, as is anything posted since
+        (StatsSubmission.query
+         .filter(or_(StatsSubmission.counted != None, StatsSubmission.created > cursor.position))
+         .update({'counted_comments': StatsSubmission.num_comments, 'counted': now},
+                 synchronize_session=False))
+    db.session.commit()
+
+    todo = [s.id for s in StatsSubmission.query.filter(
+        StatsSubmission.created >= since,
+        or_(StatsSubmission.counted == None,
+            StatsSubmission.counted_comments != StatsSubmission.num_comments))]
+    if reached:
+        print('# fetching {} comment trees'.format(len(todo)))
+    else:
+        print("# couldn't read back to the last run, fetching {} comment trees".format(len(todo)))
+    crawl = Crawl(todo, workers)
+    for id_, observations in crawl.run():
+        if observations is None:
+            continue
+        _record(observations)
+        StatsSubmission.query.filter(StatsSubmission.id == id_).update(
+            {'counted_comments': StatsSubmission.num_comments, 'counted': now},
+            synchronize_session=False)
+        db.session.commit()
+
+    if crawl.errors == 0 and newest is not None:
+        cursor.position = newest
+        db.session.add(cursor)
+
+    StatsAuthor.query.filter(StatsAuthor.last_seen < since).delete(synchronize_session=False)
+    StatsSubmission.query.filter(StatsSubmission.created < since).delete(synchronize_session=False)
+    db.session.commit()
+
+
+_TABLES = (StatsAuthor.__table__, StatsSubmission.__table__, StatsCursor.__table__)
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def snapshot():
+    """Everything the crawl has to go on, as something JSON can hold: {table: [row, ...]}."""
+    state = {}
+    for table in _TABLES:
+        state[table.name] = [
+            {k: v.strftime(_TIME_FORMAT) if isinstance(v, datetime) else v for k, v in row.items()}
+            for row in db.session.execute(table.select())]
+    return state
+
+
+def restore(state):
+    """Replace the stats tables with a snapshot(), or empty them if *state* is None."""
+    for table in _TABLES:
+        db.session.execute(table.delete())
+        rows = (state or {}).get(table.name)
+        if rows:
+            times = [c.name for c in table.columns if isinstance(c.type, DateTime)]
+            for row in rows:
+                for name in times:
+                    if row.get(name) is not None:
+                        row[name] = datetime.strptime(row[name], _TIME_FORMAT)
+            db.session.execute(table.insert(), rows)
+    db.session.commit()
+
+
+def active(since):
+    """How many people with each (flair, css) have posted since *since*."""
+    query = (db.session.query(StatsAuthor.flair_text, StatsAuthor.flair_css_class, func.count())
+             .filter(StatsAuthor.last_seen >= since)
+             .group_by(StatsAuthor.flair_text, StatsAuthor.flair_css_class))
+    return Counter({(flair_text, flair_css): n for flair_text, flair_css, n in query})
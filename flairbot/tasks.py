@@ -0,0 +1,79 @@
+"""Background jobs.
+
+Under uWSGI these run on a mule (see ``mule.py``). Elsewhere, run ``python manage.py worker``
+alongside the app.
+"""
+
+import threading
+import time
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+from . import ratelimit
+from .app import app
+
+logger = app.logger.getChild('tasks')
+
+_jobs = {}
+
+
+def job(interval=None):
+    """Register a background job, run every *interval* seconds and whenever it's kicked."""
+    def wrap(fn):
+        _jobs[fn.__name__] = {'fn': fn, 'interval': interval, 'last': 0}
+        return fn
+    return wrap
+
+
+def _run(name):
+    entry = _jobs.get(name)
+    if entry is None:
+        logger.warning('asked to run unknown job %r', name)
+        return
+    entry['last'] = time.time()
+    try:
+        with ratelimit.priority('batch'):
+            entry['fn']()
+    except Exception:
+        logger.exception('job %s failed', name)
+
+
+def spawn(fn, *args):
+    t = threading.Thread(target=fn, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def kick(name):
+    """Ask for job *name* to run as soon as possible, without waiting for it."""
+    if uwsgi is not None:
+        try:
+            uwsgi.mule_msg(name.encode('utf8'))
+            return
+        except Exception:
+            pass  # no mules
+    spawn(_run, name)
+
+
+def run():
+    with app.app_context():
+        while True:
+            now = time.time()
+            wait = 60
+            for name, entry in sorted(_jobs.items()):
+                if entry['interval'] is None:
+                    continue
+                if now - entry['last'] >= entry['interval']:
+                    _run(name)
+                wait = min(wait, entry['last'] + entry['interval'] - time.time())
+            wait = max(wait, 1)
+            if uwsgi is not None and uwsgi.mule_id() > 0:
+                msg = uwsgi.mule_get_msg(timeout=int(wait))
+                if msg:
+                    _run(msg.decode('utf8'))
+            else:
+                time.sleep(wait)
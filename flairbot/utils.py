@@ -1,12 +1,12 @@
 from flask import abort, g, has_request_context, make_response, redirect, request, session, url_for
-from flask.ext.script import Command
+from flask.ext.script import Command, Option
 from flask_wtf import Form
 
 from collections import Counter
 from functools import wraps
 from markupsafe import Markup
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, func, or_
 
 import binascii
 import csv
@@ -17,10 +17,12 @@ import json
 import os
 import praw
 import redis
+import shutil
+import tempfile
 import time
 
-from . import reddit
-from .app import app
+from . import memo, ratelimit, reddit, tasks
+from .app import app, db
 
 
 class LogoutForm(Form):
@@ -79,6 +81,62 @@ def mimetype(mimetype_):
     return wrap
 
 
+class KeysetPage(object):
+    """One page of a query, newest first, with cursors for the pages either side."""
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+
+def _encode_cursor(value, id_):
+    return '{}~{}'.format(value.strftime('%Y%m%d%H%M%S%f'), id_)
+
+
+def _decode_cursor(cursor):
+    try:
+        value, id_ = cursor.split('~', 1)
+        return datetime.datetime.strptime(value, '%Y%m%d%H%M%S%f'), id_
+    except ValueError:
+        abort(400)
+
+
+def keyset_query(query, column, id_column, older=None, newer=None):
+    """Order *query* by (*column*, *id_column*) descending, starting after the cursor *older*, or
+    ascending from the cursor *newer* (so reverse what it returns)."""
+    if newer is not None:
+        value, id_ = _decode_cursor(newer)
+        return (query.filter(or_(column > value, and_(column == value, id_column > id_)))
+                .order_by(column.asc(), id_column.asc()))
+    if older is not None:
+        value, id_ = _decode_cursor(older)
+        query = query.filter(or_(column < value, and_(column == value, id_column < id_)))
+    return query.order_by(column.desc(), id_column.desc())
+
+
+def keyset_page(query, column, id_column, older=None, newer=None, per_page=50):
+    """Fetch a page of *query* newest first, by (*column*, *id_column*).
+
+    Unlike ``paginate`` there's no COUNT and no OFFSET, so every page costs the same as the first.
+    *column* must not be NULL for anything in the query.
+    """
+    items = keyset_query(query, column, id_column, older, newer).limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if newer is not None:
+        items.reverse()
+    if not items:
+        return KeysetPage(items)
+    first, last = items[0], items[-1]
+    cursor_first = _encode_cursor(getattr(first, column.key), getattr(first, id_column.key))
+    cursor_last = _encode_cursor(getattr(last, column.key), getattr(last, id_column.key))
+    if newer is not None:
+        return KeysetPage(items, older=cursor_last, newer=cursor_first if more else None)
+    return KeysetPage(items, older=cursor_last if more else None,
+                      newer=cursor_first if older is not None else None)
+
+
 def require_authorization(*scopes, **kw):
     if len(scopes) == 1 and (isinstance(scopes[0], list) or isinstance(scopes[0], set)):
         scopes = scopes[0]
@@ -109,6 +167,7 @@ def is_authorized(*scopes):
     return has_scopes >= set(scopes)
 
 
+@memo.per_request
 def is_admin():
     if 'REDDIT_USER' not in session:
         return False
@@ -134,6 +193,35 @@ class AuthCommand(Command):
             break
 
 
+class WorkerCommand(Command):
+    "run background jobs (not needed under uWSGI, which runs them on a mule)"
+
+    def run(self):
+        tasks.run()
+
+
+class SyncFlairCommand(Command):
+    "finish a full pass of the flair mirror now"
+
+    def run(self):
+        with ratelimit.priority('batch'):
+            reddit.sync_flair_mirror(full=True)
+
+
+class ExplainCommand(Command):
+    "check that the app's queries are using indexes"
+
+    option_list = (
+        Option('-v', '--verbose', action='store_true', help='print every query plan'),
+    )
+
+    def run(self, verbose):
+        from . import explain
+        flagged = explain.check(verbose)
+        print('{} queries flagged'.format(flagged))
+        return 1 if flagged else 0
+
+
 def authorize_url(r, state, scope, **kwargs):
     token = binascii.hexlify(os.urandom(16)).decode('ascii')
     remote_addr = '*'
@@ -199,65 +287,94 @@ def get_flair_selector(r, subreddit):
     r.config.API_PATHS['flairselector'] = 'r/%s/api/flairselector'
     return r.request_json(r.config['flairselector'] % subreddit, data=True)
 
+def trade_activity_query(since):
+    from .models import Trade
+    return (db.session.query(Trade.creator_flair, Trade.creator_flair_css,
+                             Trade.target_flair, Trade.target_flair_css, func.count())
+            .filter(Trade.status == 'finished', Trade.finalized > since)
+            .group_by(Trade.creator_flair, Trade.creator_flair_css,
+                      Trade.target_flair, Trade.target_flair_css))
+
+
+def trade_activity(since):
+    """Count the trades finished since *since* that each (flair, css) was part of, on either side."""
+    activity = Counter()
+    for creator_flair, creator_css, target_flair, target_css, n in trade_activity_query(since):
+        activity[(creator_flair, creator_css)] += n
+        if (target_flair, target_css) != (creator_flair, creator_css):
+            activity[(target_flair, target_css)] += n
+    return activity
+
 class StatsCommand(Command):
     """compute flair stats"""
 
-    def run(self):
-        from .models import Trade
-        r = reddit.get(moderator=True)
-        active = Counter()
-        authors = set()
-        stop = time.time() - 2592000
-        dstop = datetime.datetime.utcfromtimestamp(stop)
-        print('# reading submissions')
-        n = 0
-        m = 0
-        for s in r.get_subreddit(app.config['REDDIT_SUBREDDIT']).get_new(limit=None):
-            if s.created_utc < stop:
-                break
-            n += 1
-            s.replace_more_comments(limit=None, threshold=0)
-            flat = praw.helpers.flatten_tree(s.comments)
-            for c in flat:
-                m += 1
-                if c.author is None:
-                    continue
-                if c.author.name in authors:
-                    continue
-                authors.add(c.author.name)
-                active[(c.author_flair_text, c.author_flair_css_class)] += 1
-            if s.author.name in authors:
-                continue
-            authors.add(s.author.name)
-            active[(s.author_flair_text, s.author_flair_css_class)] += 1
-        print('({} submissions, {} comments)'.format(n, m))
-        print('# reading flair selector')
-        r = reddit.get(moderator=True)
-        selector = get_flair_selector(r, app.config['REDDIT_SUBREDDIT'])
-        available = set()
-        for f in selector['choices']:
-            available.add((f['flair_text'], f['flair_css_class'][6:]))
-        frequency = Counter()
-        print('# reading user flair list')
-        r = reddit.get(moderator=True)
-        for flair in r.get_flair_list(app.config['REDDIT_SUBREDDIT'], limit=None):
-            frequency[(flair['flair_text'], flair['flair_css_class'])] += 1
-        print("# smokin' and writin'")
-        with open('stats.csv', 'w') as f:
-            wr = csv.writer(f)
-            wr.writerow(['flair text', 'css class', 'enabled', 'total count', 'active count', 'trade activity'])
-            for flair in sorted(frequency.keys(), key=lambda k: (-frequency[k], k[0])):
-                if flair[0] is None or flair[1] is None or flair[0] == '':
-                    continue
-                at = Trade.query\
-                    .filter(
-                        Trade.status == 'finished',
-                        Trade.finalized > stop,
-                        or_(
-                            and_(Trade.creator_flair == flair[0],
-                                 Trade.creator_flair_css == flair[1]),
-                            and_(Trade.target_flair == flair[0],
-                                 Trade.target_flair_css == flair[1])))\
-                    .count()
-                av = 'YES' if flair in available else 'NO'
-                wr.writerow([flair[0], flair[1], av, frequency[flair], active[flair], at])
+    option_list = (
+        Option('-w', '--workers', type=int, default=None,
+               help='how many comment trees to fetch at once (default: STATS_WORKERS)'),
+        Option('--record', metavar='FILE', help="save what reddit says to FILE"),
+        Option('--replay', metavar='FILE', help="use what reddit said in FILE, from a --record run"),
+        Option('--no-latency', action='store_true', help='with --replay, answer immediately'),
+        Option('--db', dest='db_url', metavar='URL',
+               help="with --replay, the database to use, which is emptied first (default: a "
+                    "temporary SQLite file); never the app's own"),
+    )
+
+    def run(self, workers, record, replay, no_latency, db_url):
+        from . import replay as replay_, stats
+        if record:
+            app.config['REDDIT_RECORD'] = record
+            replay_.save_state('stats', stats.snapshot())
+        if not replay:
+            return self.compute(workers, from_reddit=bool(record))
+        # a replay has to start where the recording did, and its month-old crawl (which can take
+        # hours) mustn't touch the real tables, or hold them up
+        if db_url is not None and db_url == app.config['SQLALCHEMY_DATABASE_URI']:
+            print("--db has to be a database of its own, not the app's")
+            return 1
+        app.config['REDDIT_REPLAY'] = replay
+        app.config['REDDIT_REPLAY_LATENCY'] = not no_latency
+        saved = replay_.state('stats')
+        if saved is None:
+            print('# no stats state in {}; starting from nothing'.format(replay))
+        tmp = tempfile.mkdtemp(prefix='flairbot-replay-') if db_url is None else None
+        db.session.remove()
+        live = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url or 'sqlite:///' + os.path.join(tmp, 'stats.db')
+        try:
+            db.create_all()
+            stats.restore(saved)
+            self.compute(workers, from_reddit=True)
+        finally:
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = live
+            if tmp is not None:
+                shutil.rmtree(tmp)
+
+    def compute(self, workers, from_reddit):
+        from . import replay as replay_, stats
+        # all of it: the flair list alone can be hundreds of pages, and the site comes first
+        with ratelimit.priority('batch'):
+            dstop = replay_.now() - datetime.timedelta(days=30)
+            stats.update(dstop, workers)
+            active = stats.active(dstop)
+            print('# reading flair selector')
+            r = reddit.get(moderator=True)
+            selector = get_flair_selector(r, app.config['REDDIT_SUBREDDIT'])
+            available = set()
+            for f in selector['choices']:
+                available.add((f['flair_text'], f['flair_css_class'][6:]))
+            frequency = Counter()
+            print('# reading user flair list')
+            for flair in reddit.iter_flair_list(from_reddit=from_reddit):
+                frequency[(flair['flair_text'], flair['flair_css_class'])] += 1
+            print('# counting trades')
+            activity = trade_activity(dstop)
+            print("# smokin' and writin'")
+            with open('stats.csv', 'w') as f:
+                wr = csv.writer(f)
+                wr.writerow(['flair text', 'css class', 'enabled', 'total count', 'active count', 'trade activity'])
+                for flair in sorted(frequency.keys(), key=lambda k: (-frequency[k], k[0])):
+                    if flair[0] is None or flair[1] is None or flair[0] == '':
+                        continue
+                    av = 'YES' if flair in available else 'NO'
+                    wr.writerow([flair[0], flair[1], av, frequency[flair], active[flair], activity[flair]])
@@ -1,4 +1,4 @@
-from flask import abort, flash, g, redirect, render_template, request, session, url_for
+from flask import abort, flash, g, make_response, redirect, render_template, request, session, url_for
 from flask_wtf import Form
 
 from wtforms.fields import HiddenField, StringField
@@ -6,7 +6,7 @@ from wtforms.validators import Optional, Length, Regexp
 
 from sqlalchemy.exc import IntegrityError
 
-from . import reddit, utils
+from . import browse, flairqueue, matching, reddit, utils
 from .app import app, db
 from .models import GiveawayLog, Trade
 
@@ -22,6 +22,16 @@ class CreateTradeForm(Form):
     special_warning = HiddenField()
 
 
+def _strip(value):
+    return (value or '').strip() or None
+
+
+class BrowseForm(Form):
+    offer = StringField('Offering flair', filters=[_strip], validators=[Optional(), Length(-1,256)])
+    css = StringField('Offering CSS class', filters=[_strip], validators=[Optional(), Length(-1,64)])
+    want = StringField('Wanting flair', filters=[_strip], validators=[Optional(), Length(-1,256)])
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -32,10 +42,7 @@ def index():
 def trade_new():
     form = CreateTradeForm()
 
-    existing = (Trade.query_valid()
-            .filter(Trade.creator == session['REDDIT_USER'])
-            .limit(1)
-            .all())
+    existing = Trade.query_valid_by(session['REDDIT_USER']).limit(1).all()
 
     if len(existing) > 0:
         flash('You already have a trade open. If you wish to make a different trade, delete it first.', 'alert')
@@ -86,8 +93,10 @@ def trade_new():
             flash('Please fill in exactly one of the text boxes to set up your trade.', 'alert')
             return render_template('create.html', form=form)
         db.session.add(trade)
+        pair = matching.find_pair(trade)
         db.session.commit()
-        return render_template('created.html', trade=trade)
+        browse.changed()
+        return render_template('created.html', trade=trade, pair=pair)
 
     return render_template('create.html', form=form)
 
@@ -105,9 +114,12 @@ def trade_view(trade_id):
     ok = True
     you = False
     message = ''
+    flair_state = trade.flair_state
 
     if trade.deleted:
         ok, message = False, "This trade has been deleted by its creator."
+    elif trade.status == 'invalid' and flair_state == 'failed':
+        ok, message = False, "This trade couldn't be completed because reddit wouldn't accept the flair changes."
     elif trade.status == 'invalid':
         ok, message = False, "This trade is no longer valid because its creator changed their flair."
     elif trade.status == 'finished':
@@ -115,15 +127,20 @@ def trade_view(trade_id):
 but it can't be accepted again."
 
     if ok is False:
-        return render_template('trade_view.html', ok=False, you=you, message=message, trade=trade, form=form)
+        return render_template('trade_view.html', ok=False, you=you, message=message, trade=trade, form=form,
+                               flair_state=flair_state)
 
     if g.reddit_identity and trade.target is not None and trade.target != g.reddit_identity:
         ok, message = False, "This trade can only be accepted by /u/{}.".format(trade.target)
 
+    pair = None
+    cycles = []
     if trade.creator == g.reddit_identity:
         message = "You own this trade. You can cancel it using the button below."
         you = True
         ok = False
+        pair = matching.find_pair(trade)
+        cycles = matching.cycles_for(trade)
 
     if ok and g.reddit_identity:
         flair = reddit.get_flair(g.reddit_identity)
@@ -135,107 +152,171 @@ but it can't be accepted again."
     else:
         your_flair = None
 
-    return render_template('trade_view.html', ok=ok, you=you, your_flair=your_flair, message=message, trade=trade, form=form)
+    return render_template('trade_view.html', ok=ok, you=you, your_flair=your_flair, message=message, trade=trade, form=form,
+                           flair_state=flair_state, pair=pair, cycles=cycles)
+
+
+@app.route('/t/')
+@utils.require_authorization('identity', failure_passthrough=True)
+def trade_browse():
+    # a GET search: there's nothing to protect, and no token to check
+    form = BrowseForm(request.args, csrf_enabled=False)
+    results = None
+    if form.validate():
+        results = browse.results(offer=form.offer.data, offer_css=form.css.data, want=form.want.data,
+                                 older=request.args.get('older'), newer=request.args.get('newer'))
+
+    your_flair = your_flair_text = None
+    if g.reddit_identity:
+        flair = reddit.get_flair(g.reddit_identity)
+        if flair is not None and flair['flair_text']:
+            your_flair, your_flair_text = utils.render_flair(flair), flair['flair_text']
+
+    return render_template('browse.html', form=form, results=results, your_flair=your_flair,
+                           your_flair_text=your_flair_text)
 
 
 @app.route('/t/<trade_id>/accept', methods=('GET', 'POST'))
 @utils.require_authorization('identity')
 def trade_accept(trade_id):
-    r = reddit.get(moderator=True)
-
-    trade = Trade.by_id(trade_id, allow_invalid=True, allow_finished=True, for_update=True)
+    # nothing here holds a lock: the trade is claimed with a conditional UPDATE at the end, so
+    # whoever gets there first wins, and reddit's latency never holds up the database
+    trade = Trade.by_id(trade_id, allow_invalid=True, allow_finished=True)
     if trade is None:
         abort(404)
 
-    try:
-        form = ActionTradeForm()
+    form = ActionTradeForm()
 
-        if trade.status not in ('valid', 'giveaway') or trade.deleted:
-            flash("This trade is no longer valid.", 'alert')
-            return redirect(url_for('trade_view', trade_id=trade_id)), 303
-        elif trade.creator == g.reddit_identity:
-            flash("You can't accept your own trade.", 'alert')
-            return redirect(url_for('trade_view', trade_id=trade_id)), 303
-        elif trade.target is not None and trade.target != g.reddit_identity:
-            flash("This trade can only be accepted by /u/{}".format(trade.target), 'alert')
-            return redirect(url_for('trade_view', trade_id=trade_id)), 303
+    if trade.status not in ('valid', 'giveaway') or trade.deleted:
+        flash("This trade is no longer valid.", 'alert')
+        return redirect(url_for('trade_view', trade_id=trade_id)), 303
+    elif trade.creator == g.reddit_identity:
+        flash("You can't accept your own trade.", 'alert')
+        return redirect(url_for('trade_view', trade_id=trade_id)), 303
+    elif trade.target is not None and trade.target != g.reddit_identity:
+        flash("This trade can only be accepted by /u/{}".format(trade.target), 'alert')
+        return redirect(url_for('trade_view', trade_id=trade_id)), 303
+
+    if not form.validate_on_submit():
+        return redirect(url_for('trade_view', trade_id=trade_id)), 303
+    if form.act_id.data != trade.id:
+        abort(400)
+
+    # end the read transaction before going to reddit. detach the trade first, or touching it
+    # would just start another one
+    db.session.expunge(trade)
+    db.session.rollback()
 
-        if not form.validate_on_submit():
+    if trade.status != 'giveaway':
+        # the creator's flair is needed to check the trade still stands, so get both at once
+        flairs = reddit.get_flairs([g.reddit_identity, trade.creator], no_cache=True)
+        flair, creator_flair = flairs[g.reddit_identity], flairs[trade.creator]
+    else:
+        flair = reddit.get_flair(g.reddit_identity, no_cache=True)
+    if trade.status != 'giveaway':
+        if flair['flair_text'] == '':
+            flash("You don't have flair on /r/{}.".format(app.config['REDDIT_SUBREDDIT']), 'alert')
+            return redirect(url_for('trade_view', trade_id=trade_id)), 303
+        if (trade.target_flair not in (None, flair['flair_text']) or
+            trade.target_flair_css not in (None, flair['flair_css_class'])):
+            flash("You don't meet the requirements specified by this trade.", 'alert')
             return redirect(url_for('trade_view', trade_id=trade_id)), 303
-        if form.act_id.data != trade.id:
-            abort(400)
+    else:
+        if trade.creator_flair == flair['flair_text'] and trade.creator_flair_css == flair['flair_css_class']:
+            flash("You already have the offered flair.", 'alert')
+            return redirect(url_for('trade_view', trade_id=trade_id))
 
-        flair = reddit.get_flair(g.reddit_identity, no_cache=True)
+    try:
         if trade.status != 'giveaway':
-            if flair['flair_text'] == '':
-                flash("You don't have flair on /r/{}.", 'alert')
-                return redirect(url_for('trade_view', trade_id=trade_id)), 303
-            if (trade.target_flair not in (None, flair['flair_text']) or
-                trade.target_flair_css not in (None, flair['flair_css_class'])):
-                flash("You don't meet the requirements specified by this trade.", 'alert')
-                return redirect(url_for('trade_view', trade_id=trade_id)), 303
-        else:
-            if trade.creator_flair == flair['flair_text'] and trade.creator_flair_css == flair['flair_css_class']:
-                flash("You already have the offered flair.", 'alert')
-                return redirect(url_for('trade_view', trade_id=trade_id))
-    finally:
-        db.session.rollback()
-
-    if trade.status != 'giveaway':
-        try:
             # one extra thing: check the creator's flair matches what we saved
-            creator_flair = reddit.get_flair(trade.creator, no_cache=True)
             if (creator_flair['flair_text'] != trade.creator_flair or
                     creator_flair['flair_css_class'] != trade.creator_flair_css):
-                trade.set_status('invalid')
+                Trade.invalidate(trade.id)
                 db.session.commit()
-                return display(ok=False)
-        except IntegrityError:
-            db.session.rollback()
+                browse.changed()
+                flash("This trade is no longer valid because its creator changed their flair.", 'alert')
+                return redirect(url_for('trade_view', trade_id=trade_id)), 303
 
-    try:
-        if trade.status != 'giveaway':
             # actually make the trade
-            trade.target = g.reddit_identity
-            trade.target_flair = flair['flair_text']
-            trade.target_flair_css = flair['flair_css_class']
-            trade.target_ip = request.remote_addr
-            trade.set_status('finished')
-            r.set_flair_csv(app.config['REDDIT_SUBREDDIT'], [
+            claimed = Trade.claim(trade.id,
+                                  target=g.reddit_identity,
+                                  target_flair=flair['flair_text'],
+                                  target_flair_css=flair['flair_css_class'],
+                                  target_ip=request.remote_addr)
+            if not claimed:
+                db.session.rollback()
+                flash("This trade is no longer valid.", 'alert')
+                return redirect(url_for('trade_view', trade_id=trade_id)), 303
+            flairqueue.enqueue([
                 {'user': g.reddit_identity,
                  'flair_text': creator_flair['flair_text'],
                  'flair_css_class': creator_flair['flair_css_class']},
                 {'user': trade.creator,
                  'flair_text': flair['flair_text'],
-                 'flair_css_class': flair['flair_css_class']}])
+                 'flair_css_class': flair['flair_css_class']}], trade=trade)
             db.session.commit()
+            browse.changed()
+            flairqueue.kick()
             creator_flair['user'] = g.reddit_identity
             flair['user'] = trade.creator
             reddit.update_flair_cache(g.reddit_identity, creator_flair)
             reddit.update_flair_cache(trade.creator, flair)
             return render_template('accept_success.html', trade=trade)
         else:
-            trade.giveaway_count -= 1
-            if trade.giveaway_count <= 0:
-                trade.set_status('finished')
+            # take the copy first: that locks the trade row before the log's foreign key wants a
+            # shared lock on it, so two claims queue up at the UPDATE instead of deadlocking
+            if not Trade.claim_giveaway(trade.id):
+                db.session.rollback()
+                flash("Sorry, this giveaway has run out.", 'alert')
+                return redirect(url_for('trade_view', trade_id=trade_id)), 303
+            logent = GiveawayLog(trade, g.reddit_identity, flair['flair_text'], flair['flair_css_class'], request.remote_addr)
+            db.session.add(logent)
+            try:
+                # the unique index on (trade_id, target) turns away a second claim
+                db.session.flush()
+            except IntegrityError:
+                db.session.rollback()  # which puts the copy back
+                flash("You've already claimed this giveaway.", 'alert')
+                return redirect(url_for('trade_view', trade_id=trade_id)), 303
             new_flair = {
                 'user': g.reddit_identity,
                 'flair_text': trade.creator_flair,
                 'flair_css_class': trade.creator_flair_css
                 }
-            r.set_flair_csv(app.config['REDDIT_SUBREDDIT'], [new_flair])
-            logent = GiveawayLog(trade, g.reddit_identity, flair['flair_text'], flair['flair_css_class'], request.remote_addr)
-            db.session.add(logent)
+            flairqueue.enqueue([new_flair], trade=trade, giveaway_log=logent)
             db.session.commit()
+            flairqueue.kick()
             reddit.update_flair_cache(g.reddit_identity, new_flair)
             return render_template('giveaway_success.html', trade=trade)
-    except IntegrityError:
-        db.session.rollback()
     except BaseException:
         db.session.rollback()
         raise
 
 
+@app.route('/t/<trade_id>/cycle/<int:cycle_id>', methods=('POST',))
+@utils.require_authorization('identity')
+def trade_cycle_agree(trade_id, cycle_id):
+    trade = Trade.by_id(trade_id)
+    if trade is None or trade.creator != g.reddit_identity:
+        abort(404)
+
+    form = ActionTradeForm()
+
+    if not form.validate_on_submit() or form.act_id.data != trade.id:
+        abort(400)
+
+    result = matching.agree(cycle_id, trade)
+    if result is None:
+        abort(404)
+    elif result == 'agreed':
+        flash("Thanks! The swap will go ahead as soon as everyone else in it agrees too.")
+    elif result == 'finished':
+        flash("Everyone agreed, so the swap is done. Your new flair is on its way.")
+    else:
+        flash("Sorry, that swap can't go ahead any more: someone's trade or flair has changed.", 'alert')
+    return redirect(url_for('trade_view', trade_id=trade.id)), 303
+
+
 @app.route('/t/<trade_id>/delete', methods=('POST',))
 @utils.require_authorization('identity')
 def trade_delete(trade_id):
@@ -250,6 +331,7 @@ def trade_delete(trade_id):
             abort(403)
         trade.deleted = True
         db.session.commit()
+        browse.changed()
         flash('Trade successfully deleted.')
         if utils.is_admin():
             return redirect(url_for('trade_view', trade_id=trade.id)), 303
@@ -273,6 +355,7 @@ def trade_undelete(trade_id):
             abort(404)
         trade.deleted = False
         db.session.commit()
+        browse.changed()
         flash('Trade successfully undeleted.')
         return redirect(url_for('trade_view', trade_id=trade.id)), 303
 
@@ -291,9 +374,9 @@ def trade_revert(trade_id):
     if form.validate_on_submit() and form.act_id.data == trade.id:
         if not utils.is_admin():
             abort(404)
-        r = reddit.get(moderator=True)
         trade.deleted = True
         trade.set_status('valid')
+        trade.flair_applied = None
         target_flair, creator_flair = (
             {'user': trade.target,
              'flair_text': trade.target_flair,
@@ -302,10 +385,11 @@ def trade_revert(trade_id):
              'flair_text': trade.creator_flair,
              'flair_css_class': trade.creator_flair_css})
 
-        r.set_flair_csv(app.config['REDDIT_SUBREDDIT'], [creator_flair, target_flair])
+        flairqueue.enqueue([creator_flair, target_flair], trade=trade)
+        db.session.commit()
+        flairqueue.kick()
         reddit.update_flair_cache(trade.creator, creator_flair)
         reddit.update_flair_cache(trade.target, target_flair)
-        db.session.commit()
         flash('Trade successfully reverted.')
         return redirect(url_for('trade_view', trade_id=trade.id)), 303
 
@@ -339,4 +423,15 @@ def logout(returnto=None):
 @app.route('/subreddit.css')
 @utils.mimetype('text/css')
 def subreddit_css():
-    return reddit.get_stylesheet()
+    sheet = reddit.get_stylesheet()
+    if request.accept_encodings['gzip']:
+        response = make_response(sheet['gzip'])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(sheet['etag'] + '-gz')
+    else:
+        response = make_response(sheet['css'])
+        response.set_etag(sheet['etag'])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['STYLESHEET_MAX_AGE']
+    return response.make_conditional(request)
@@ -11,6 +11,9 @@ manager.add_command('db', MigrateCommand)
 
 manager.add_command('setup-auth', utils.AuthCommand)
 manager.add_command('stats', utils.StatsCommand)
+manager.add_command('worker', utils.WorkerCommand)
+manager.add_command('sync-flair', utils.SyncFlairCommand)
+manager.add_command('explain', utils.ExplainCommand)
 
 if __name__ == "__main__":
     manager.run()
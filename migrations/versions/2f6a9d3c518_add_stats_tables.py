@@ -0,0 +1,47 @@
+"""add stats tables
+
+Revision ID: 2f6a9d3c518
+Revises: 6d41c0a8f27
+Create Date: 2026-10-18 13:21:09.460385
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f6a9d3c518'
+down_revision = '6d41c0a8f27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('stats_author',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('flair_text', sa.String(length=256), nullable=True),
+        sa.Column('flair_css_class', sa.String(length=64), nullable=True),
+        sa.Column('last_seen', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.create_index('ix_stats_author_last_seen', 'stats_author', ['last_seen'], unique=False)
+    op.create_table('stats_submission',
+        sa.Column('id', sa.String(length=16), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('num_comments', sa.Integer(), nullable=True),
+        sa.Column('counted_comments', sa.Integer(), nullable=True),
+        sa.Column('counted', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_stats_submission_created', 'stats_submission', ['created'], unique=False)
+    op.create_table('stats_cursor',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('position', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('stats_cursor')
+    op.drop_index('ix_stats_submission_created', table_name='stats_submission')
+    op.drop_table('stats_submission')
+    op.drop_index('ix_stats_author_last_seen', table_name='stats_author')
+    op.drop_table('stats_author')
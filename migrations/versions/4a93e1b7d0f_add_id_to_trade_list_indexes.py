@@ -0,0 +1,34 @@
+"""add id to trade list indexes
+
+Revision ID: 4a93e1b7d0f
+Revises: 2f6a9d3c518
+Create Date: 2026-10-18 14:02:51.118230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a93e1b7d0f'
+down_revision = '2f6a9d3c518'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+indexes = [
+    ('ix_trade_status_finalized', ['status', 'deleted', 'finalized']),
+    ('ix_trade_status_created', ['status', 'deleted', 'created']),
+    ('ix_trade_deleted_created', ['deleted', 'created']),
+]
+
+
+def upgrade():
+    # the admin lists page by (time, id), so the index has to be in that order too
+    for name, columns in indexes:
+        op.drop_index(name, table_name='trade')
+        op.create_index(name, 'trade', columns + ['id'], unique=False)
+
+
+def downgrade():
+    for name, columns in indexes:
+        op.drop_index(name, table_name='trade')
+        op.create_index(name, 'trade', columns, unique=False)
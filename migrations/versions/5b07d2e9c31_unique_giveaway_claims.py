@@ -0,0 +1,30 @@
+"""unique giveaway claims
+
+Revision ID: 5b07d2e9c31
+Revises: 3e8b1f42a7c
+Create Date: 2026-10-18 11:40:07.218653
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b07d2e9c31'
+down_revision = '3e8b1f42a7c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    conn = op.get_bind()
+    duplicates = conn.execute(sa.text(
+        'SELECT trade_id, target, COUNT(*) FROM giveaway_log '
+        'GROUP BY trade_id, target HAVING COUNT(*) > 1')).fetchall()
+    if duplicates:
+        # these are the audit trail; don't throw any away without a human looking first
+        raise RuntimeError('giveaway_log has repeated claims, resolve them before upgrading: '
+                           + ', '.join('trade {} /u/{} x{}'.format(*row) for row in duplicates))
+    op.create_index('ix_giveaway_log_trade_target', 'giveaway_log', ['trade_id', 'target'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_giveaway_log_trade_target', table_name='giveaway_log')
@@ -0,0 +1,35 @@
+"""add trade indexes
+
+Revision ID: 6d41c0a8f27
+Revises: 5b07d2e9c31
+Create Date: 2026-10-18 12:05:44.903172
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d41c0a8f27'
+down_revision = '5b07d2e9c31'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# giveaway_log.trade_id is already covered by ix_giveaway_log_trade_target
+indexes = [
+    ('ix_trade_creator', ['creator', 'status', 'deleted'], {}),
+    ('ix_trade_status_finalized', ['status', 'deleted', 'finalized'], {}),
+    ('ix_trade_status_created', ['status', 'deleted', 'created'], {}),
+    ('ix_trade_deleted_created', ['deleted', 'created'], {}),
+    ('ix_trade_creator_flair', ['creator_flair', 'creator_flair_css'], {'mysql_length': {'creator_flair': 191}}),
+    ('ix_trade_target_flair', ['target_flair', 'target_flair_css'], {'mysql_length': {'target_flair': 191}}),
+]
+
+
+def upgrade():
+    for name, columns, kw in indexes:
+        op.create_index(name, 'trade', columns, unique=False, **kw)
+
+
+def downgrade():
+    for name, columns, kw in reversed(indexes):
+        op.drop_index(name, table_name='trade')
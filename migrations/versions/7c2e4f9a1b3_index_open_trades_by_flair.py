@@ -0,0 +1,43 @@
+"""index open trades by flair
+
+Revision ID: 7c2e4f9a1b3
+Revises: 4a93e1b7d0f
+Create Date: 2026-10-18 16:40:12.307514
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2e4f9a1b3'
+down_revision = '4a93e1b7d0f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+old_indexes = [
+    ('ix_trade_creator_flair', ['creator_flair', 'creator_flair_css'], {'mysql_length': {'creator_flair': 191}}),
+    ('ix_trade_target_flair', ['target_flair', 'target_flair_css'], {'mysql_length': {'target_flair': 191}}),
+]
+
+# the browse page filters open trades by one of these and pages them by (created, id)
+indexes = [
+    ('ix_trade_open_offer', ['status', 'deleted', 'creator_flair', 'created', 'id'],
+     {'mysql_length': {'creator_flair': 191}}),
+    ('ix_trade_open_offer_css', ['status', 'deleted', 'creator_flair_css', 'created', 'id'], {}),
+    ('ix_trade_open_want', ['status', 'deleted', 'target_flair', 'created', 'id'],
+     {'mysql_length': {'target_flair': 191}}),
+]
+
+
+def upgrade():
+    for name, columns, kw in old_indexes:
+        op.drop_index(name, table_name='trade')
+    for name, columns, kw in indexes:
+        op.create_index(name, 'trade', columns, unique=False, **kw)
+
+
+def downgrade():
+    for name, columns, kw in reversed(indexes):
+        op.drop_index(name, table_name='trade')
+    for name, columns, kw in old_indexes:
+        op.create_index(name, 'trade', columns, unique=False, **kw)
@@ -0,0 +1,3 @@
+from flairbot import tasks
+
+tasks.run()